@@ -3,16 +3,66 @@ __version__ = "0.1"
 
 import sublime
 import sublime_plugin
-from library import Library
+from library import Library, performanceStats
 import threading
 import os
 import re
+import time
+import itertools
+try:
+    import cProfile
+except ImportError:
+    cProfile = None
+
+
+profileNumbers = itertools.count()
+
+
+def profileSettings():
+    """Returns the directory profiles are written to and how many of them are kept there, or None
+    if the profile_directory setting isn't set. Like most of the Sublime Text API, it has to be
+    called on the main thread"""
+    settings = sublime.load_settings("ZoteroCite.sublime-settings")
+    directory = settings.get("profile_directory")
+    if not directory or cProfile is None:
+        return None
+    # Relative to the User folder
+    return (os.path.join(sublime.packages_path(), "User", os.path.expanduser(directory)),
+            settings.get("profile_count", 20))
+
+
+def profiled(name, settings, func, *args):
+    """Calls func with args and returns its result. Given the profileSettings(), the call is
+    profiled and the profile written to their directory as <name>-<time>.pstats. Only the newest
+    profiles are kept there. It doesn't use the Sublime Text API, so any thread can call it"""
+    if settings is None:
+        return func(*args)
+    directory, keep = settings
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        fileName = "%s-%s-%d.pstats" % (name, time.strftime("%Y%m%d-%H%M%S"), profileNumbers.next())
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            profile.dump_stats(os.path.join(directory, fileName))
+            removeOldProfiles(directory, keep)
+        except (IOError, OSError), e:
+            print "Warning: Couldn't write profile %s: %s" % (fileName, e)
+
+
+def removeOldProfiles(directory, keep):
+    profiles = [os.path.join(directory, fileName) for fileName in os.listdir(directory) if fileName.endswith(".pstats")]
+    profiles.sort(key=lambda path: (os.path.getmtime(path), path))
+    for path in profiles[:max(0, len(profiles) - keep)]:
+        os.remove(path)
 
 
 class UpdateLibraryCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         if Library.hasLibraryForView(self.view):
-            UpdateThread(Library.getLibraryForView(self.view)).start()
+            UpdateThread(Library.getLibraryForView(self.view), profileSettings()).start()
 
     def is_enabled(self):
         return Library.hasLibraryForView(self.view)
@@ -53,9 +103,9 @@ class InsertCitationCommand(sublime_plugin.TextCommand):
         needs to contain %%s where the citation-key should be inserted"""
         library = self.getLibrary()
         self.citeType = citeType
-        self.selectionList = library.LibraryItems
-        self.selectionList.sort(key=lambda x: x.menuRows[0])
-        selectFrom = [item.menuRows for item in self.selectionList]
+        self.citeAsynchronously = sublime.load_settings("ZoteroCite.sublime-settings").get("insert_citations_asynchronously", True)
+
+        self.selectionList, selectFrom = profiled("panel", profileSettings(), lambda: library.panel)
         self.view.window().show_quick_panel(selectFrom, self.callBack)
 
     def getLibrary(self):
@@ -67,7 +117,14 @@ class InsertCitationCommand(sublime_plugin.TextCommand):
 
     def callBack(self, arg):
         if arg > -1:
-            self.insertCitation(self.getLibrary().cite(self.selectionList[arg]))
+            libItem = self.selectionList[arg]
+            if self.citeAsynchronously and not self.getLibrary().canCiteOffline(libItem):
+                # Insert a placeholder, which is replaced once Zotero returned the citekey
+                placeholder = "zotero:%s" % libItem.id
+                self.insertCitation(placeholder)
+                CiteThread(self.view, self.getLibrary(), libItem, placeholder).start()
+            else:
+                self.insertCitation(self.getLibrary().cite(libItem))
         else:
             self.getLibrary().removeLibraryForView()
 
@@ -142,6 +199,35 @@ class InsertCitationCommand(sublime_plugin.TextCommand):
         return default
 
 
+class SearchCitationCommand(InsertCitationCommand):
+    def run(self, edit, citeType=None):
+        """Asks for a search query and offers the best matching items to be cited"""
+        self.citeType = citeType
+        self.citeAsynchronously = sublime.load_settings("ZoteroCite.sublime-settings").get("insert_citations_asynchronously", True)
+        self.view.window().show_input_panel("Search citation:", "", self.search, None, None)
+
+    def search(self, query):
+        self.selectionList = self.getLibrary().search(query)
+        if len(self.selectionList) == 0:
+            sublime.status_message("No citation found for \"%s\"" % query)
+            return
+        self.view.window().show_quick_panel([item.menuRows for item in self.selectionList], self.callBack)
+
+
+class ShowPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        """Shows how often and how long the library's operations took in an output panel"""
+        panel = self.window.get_output_panel("zoterocite_stats")
+        edit = panel.begin_edit()
+        try:
+            panel.erase(edit, sublime.Region(0, panel.size()))
+            panel.insert(edit, 0, performanceStats.report())
+        finally:
+            panel.end_edit(edit)
+        self.window.run_command("show_panel", {"panel": "output.zoterocite_stats"})
+        performanceStats.log()
+
+
 class PluginEventHandler(sublime_plugin.EventListener):
     def on_pre_save(self, view):
         if Library.hasLibraryForView(view):
@@ -152,11 +238,42 @@ class PluginEventHandler(sublime_plugin.EventListener):
             view.run_command("create_library")
 
 
+class CiteThread(threading.Thread):
+    def __init__(self, view, lib, libItem, placeholder):
+        self.view = view
+        self.lib = lib
+        self.libItem = libItem
+        self.placeholder = placeholder
+        super(CiteThread, self).__init__()
+
+    def run(self):
+        try:
+            key = self.lib.cite(self.libItem)
+        except Exception, e:
+            message = "Couldn't retrieve citekey for %s: %s" % (self.placeholder, e)
+            sublime.set_timeout(lambda: sublime.status_message(message), 0)
+        else:
+            sublime.set_timeout(lambda: self.replacePlaceholder(key), 0)
+
+    def replacePlaceholder(self, key):
+        regions = self.view.find_all(self.placeholder, sublime.LITERAL)
+        if len(regions) == 0:
+            return
+        edit = self.view.begin_edit("Insert Citation")
+        try:
+            # Back to front, so the remaining regions stay valid
+            for region in reversed(regions):
+                self.view.replace(edit, region, key)
+        finally:
+            self.view.end_edit(edit)
+
+
 class UpdateThread(threading.Thread):
     __updateLock = threading.Lock()
 
-    def __init__(self, lib):
+    def __init__(self, lib, profileSettings=None):
         self.lib = lib
+        self.profileSettings = profileSettings
         self.done = False
         self.__points = 0
         super(UpdateThread, self).__init__()
@@ -164,15 +281,17 @@ class UpdateThread(threading.Thread):
     def run(self):
         if self.__updateLock.acquire(False):
             sublime.set_timeout(self.update_status, 300)
+            start = time.time()
             try:
-                self.lib.update()
+                profiled("update", self.profileSettings, self.lib.update)
             finally:
                 self.__updateLock.release()
+                self.seconds = time.time() - start
                 self.done = True
 
     def update_status(self):
         if self.done:
-            sublime.status_message("")
+            sublime.status_message("Library updated in %.1fs" % self.seconds)
             return
         self.__points = self.__points % 3 + 1
         sublime.status_message("Updating Library" + self.__points*".")
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Measures reading and writing BibTex-files like the plugin does, for synthetic files of 1000 to
+200000 entries with nested braces, quoted and concatenated values, non-ASCII names, long abstracts
+and the @string and @comment entries the reader passes through. Every phase runs in a process of
+its own, so its peak memory isn't hidden by the phases before it:
+
+    parse       reading the file into BibTexEntries
+    fields      parsing the fields a library reads of every entry
+    serialize   the BibTex-strings of unmodified entries
+    relink      the BibTex-strings of entries linked to Zotero items, which are rebuilt
+    write       writing the entries back to a file
+
+Peak memory is the growth of the process' maximum resident set during the phase. Retained are the
+objects tracked by the garbage collector which the phase left alive, like the entries it built. It
+isn't the number of allocations, which Python 2 only counts in builds with COUNT_ALLOCS, so
+temporary objects show in the peak memory only. Run it with the Python 2 interpreter from the
+package folder:
+
+    python benchmarks/bibtex.py [--sizes 1000,10000,100000] [--seed 42]
+"""
+import os
+import sys
+import gc
+import time
+import json
+import codecs
+import random
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+for lib in ("pyzotero", "feedparser", "pytz-2013b", "poster-0.8.1", "ordereddict-1.1"):
+    sys.path.append(os.path.join(root, "lib", lib))
+
+from library import Library
+
+phases = ("parse", "fields", "serialize", "relink", "write")
+readFromBibFile = Library._Library__readFromBibFile
+writeToBibFile = Library._Library__writeToBibFile
+
+
+def makeBibFile(path, count, seed):
+    rand = random.Random(seed)
+    letters = u"etaoinshrdlcumwfgypbvkjxqz"
+    words = [u"".join([rand.choice(letters) for _ in xrange(rand.randint(2, 11))]) for _ in xrange(5000)]
+    names = [u"Müller", u"Østergaard", u"García", u"Šimek", u"Dvořák",
+             u"山田", u"Smith", u"Nguyễn", u"O'Brien", u"{van der Berg}"]
+
+    def sentence(minWords, maxWords):
+        return u" ".join([rand.choice(words) for _ in xrange(rand.randint(minWords, maxWords))])
+
+    with codecs.open(path, "w", "utf-8") as f:
+        f.write(u"@comment{Synthetic library, %d entries}\n" % count)
+        f.write(u'@string{jzot = "Journal of {Z}otero Studies"}\n\n')
+        for i in xrange(count):
+            author = u" and ".join([u"%s, %s" % (rand.choice(names), sentence(1, 2).title())
+                                    for _ in xrange(rand.randint(1, 6))])
+            # Nested braces protect capitalization, like Zotero exports them
+            title = u"{%s {%s} %s: {The {%s} of %s}}" % (
+                sentence(1, 6).capitalize(), rand.choice(words).upper(), sentence(0, 4), rand.choice(words).upper(),
+                sentence(1, 4))
+            fields = [
+                (u"title", title),
+                (u"author", u"{%s}" % author),
+                (u"journal", u"jzot" if rand.random() < 0.3 else u'"%s"' % sentence(2, 5).title()),
+                (u"year", unicode(rand.randint(1950, 2013))),
+                (u"month", u'jan # " 1"' if rand.random() < 0.1 else u"{%d}" % rand.randint(1, 12)),
+                (u"pages", u"{%d--%d}" % (i % 1000, i % 1000 + rand.randint(1, 40))),
+                (u"abstract", u"{%s}" % sentence(0, 400).capitalize()),
+                (u"keywords", u"{%s}" % u", ".join([rand.choice(words) for _ in xrange(rand.randint(0, 5))]))
+            ]
+            if rand.random() < 0.7:
+                fields.extend([(u"zoterodocid", u"{%08X}" % i), (u"zoterolibid", u"{123456}"),
+                               (u"zoterolibtype", u"{user}")])
+            f.write(u"@article{key%d,\n%s\n}\n" % (i, u",\n".join([u"\t%s = %s" % field for field in fields])))
+            if i % 1000 == 999:
+                f.write(u"@comment{jabref-meta: groupsversion:3;}\n")
+
+
+def runPhase(phase, path):
+    """Runs one phase on the file and returns its measurements"""
+    entries = None
+    strings = None
+    if phase != "parse":
+        entries = list(readFromBibFile(path))
+    if phase == "write":
+        strings = [entry.bibTexString for entry in entries]
+    outPath = path + ".out"
+    gc.collect()
+    retainedBefore = len(gc.get_objects())
+    rssBefore = maxRss()
+    start = time.time()
+    if phase == "parse":
+        result = list(readFromBibFile(path))
+        count = len(result)
+    elif phase == "fields":
+        result = [(entry.zoteroKey, entry.zoteroLibraryId, entry.zoteroLibraryType, entry.author, entry.title,
+                   entry.year, entry.abstract) for entry in entries]
+        count = len(entries)
+    elif phase == "serialize":
+        result = [entry.bibTexString for entry in entries]
+        count = len(entries)
+    elif phase == "relink":
+        for entry in entries:
+            entry.zoteroLink(entry.key, u"123456", u"user")
+        result = [entry.bibTexString for entry in entries]
+        count = len(entries)
+    else:
+        writeToBibFile(strings, outPath)
+        result = None
+        count = len(strings)
+    seconds = time.time() - start
+    measurements = {
+        "count": count,
+        "seconds": seconds,
+        "peakBytes": None if rssBefore is None else maxRss() - rssBefore,
+        "retained": len(gc.get_objects()) - retainedBefore
+    }
+    if os.path.exists(outPath):
+        os.remove(outPath)
+    return measurements
+
+
+def maxRss():
+    """The maximum resident set of this process so far in bytes, or None if it's unknown"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on OS X
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default="1000,10000,100000", help="comma separated entry counts, up to 200000")
+    parser.add_option("--phases", default=",".join(phases), help="comma separated phases to run")
+    parser.add_option("--seed", type="int", default=42, help="seed of the synthetic files")
+    parser.add_option("--run-phase", nargs=2, help=("run a single phase on a file and print its measurements "
+                                                    "as JSON, used by the benchmark itself"))
+    options = parser.parse_args()[0]
+    if options.run_phase:
+        print json.dumps(runPhase(*options.run_phase))
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        print "%8s %-10s %9s %12s %10s %10s %8s" % (
+            "entries", "phase", "seconds", "entries/s", "peak MB", "retained", "file MB")
+        for size in [int(size) for size in options.sizes.split(",")]:
+            path = os.path.join(directory, "library%d.bib" % size)
+            makeBibFile(path, size, options.seed)
+            fileSize = os.path.getsize(path)
+            for phase in options.phases.split(","):
+                output = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-phase", phase, path],
+                                          stdout=subprocess.PIPE).communicate()[0]
+                result = json.loads(output.strip().splitlines()[-1])
+                peak = "n/a" if result["peakBytes"] is None else "%.1f" % (result["peakBytes"] / 1048576.0)
+                print "%8d %-10s %9.3f %12.0f %10s %10d %8.1f" % (
+                    result["count"], phase, result["seconds"], result["count"] / max(result["seconds"], 1e-9),
+                    peak, result["retained"], fileSize / 1048576.0)
+    finally:
+        shutil.rmtree(directory, True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""A local stand-in for the Zotero Web API, serving synthetic libraries over HTTP, so syncs can be
+benchmarked without a Zotero account and without a network. It answers the requests the plugin
+sends: a user's groups and the top-level items of a library as JSON pages, the items deleted since
+a library version, and single items or item subsets. Like version 3 of the API, items are served
+as JSON unless format=atom is given, and content only applies to Atom. Of the Atom formats, only
+content=bibtex is supported, and pages of top-level items are only served as JSON.
+
+    server = FakeZoteroServer(items=20000, groups=30, groupItems=1000, latency=0.05)
+    server.start()
+    # Zotero instances have to use server.url as their endpoint
+    server.modify(100)
+    server.stop()
+
+Every response can be delayed by a latency, every n-th request can be answered with a 429 and a
+Retry-After header, and If-Modified-Since-Version is answered with 304 like the real API does.
+"""
+import json
+import random
+import threading
+import time
+import urlparse
+import urllib
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape, quoteattr
+
+# The characters Zotero uses in its keys
+KEY_ALPHABET = "23456789ABCDEFGHIJKLMNPQRSTUVWXYZ"
+
+
+def makeKey(number):
+    key = []
+    for _ in xrange(8):
+        number, digit = divmod(number, len(KEY_ALPHABET))
+        key.append(KEY_ALPHABET[digit])
+    return "".join(key)
+
+
+class FakeLibrary(object):
+    """A synthetic Zotero library. Its items are kept as serialized JSON, so serving them costs
+    the server as little as possible"""
+
+    def __init__(self, libId, libType, itemCount, rand, words, firstKey=0):
+        self.libId = libId
+        self.libType = libType
+        self.version = 1
+        self.__rand = rand
+        self.__words = words
+        self.__nextKey = firstKey
+        # key -> (version, JSON, BibTex-string)
+        self.__items = {}
+        self.__order = None
+        self.deletions = []
+        for _ in xrange(itemCount):
+            self.__addItem(self.__newKey())
+
+    def __newKey(self):
+        key = makeKey(self.__nextKey)
+        self.__nextKey += 1
+        return key
+
+    def __sentence(self, minWords, maxWords):
+        return u" ".join([self.__rand.choice(self.__words) for _ in xrange(self.__rand.randint(minWords, maxWords))])
+
+    def __addItem(self, key):
+        rand = self.__rand
+        creators = [{u"creatorType": u"author", u"firstName": self.__sentence(1, 2).title(),
+                     u"lastName": rand.choice(self.__words).title()} for _ in xrange(rand.randint(1, 4))]
+        data = {
+            u"key": key,
+            u"version": self.version,
+            u"itemType": u"journalArticle",
+            u"title": self.__sentence(3, 12).capitalize(),
+            u"creators": creators,
+            u"date": unicode(rand.randint(1950, 2013)),
+            u"abstractNote": self.__sentence(0, 200).capitalize(),
+            u"tags": [{u"tag": rand.choice(self.__words)} for _ in xrange(rand.randint(0, 3))]
+        }
+        obj = {u"key": key, u"version": self.version,
+               u"library": {u"type": self.libType, u"id": self.libId}, u"data": data}
+        bibTex = u"@article{%s_%s,\n\ttitle = {{%s}},\n\tauthor = {%s},\n\tyear = {%s},\n\tabstract = {%s}\n}" % (
+            creators[0][u"lastName"].lower(), data[u"date"], data[u"title"],
+            u" and ".join([u"%s, %s" % (c[u"lastName"], c[u"firstName"]) for c in creators]),
+            data[u"date"], data[u"abstractNote"])
+        self.__items[key] = (self.version, json.dumps(obj), bibTex)
+        self.__order = None
+
+    @property
+    def itemCount(self):
+        return len(self.__items)
+
+    def modify(self, count, deleteCount=0):
+        """Creates a new library version, in which count random items were changed and deleteCount
+        ones were deleted"""
+        self.version += 1
+        keys = self.__rand.sample(self.__items.keys(), min(len(self.__items), count + deleteCount))
+        for key in keys[:count]:
+            self.__addItem(key)
+        for key in keys[count:]:
+            del self.__items[key]
+            self.deletions.append((self.version, key))
+        self.__order = None
+
+    def itemsSince(self, since):
+        """The JSON of the items modified after the version since, most recently modified first"""
+        if self.__order is None:
+            self.__order = sorted(self.__items.items(), key=lambda entry: (-entry[1][0], entry[0]))
+        return [entry[1][1] for entry in self.__order if entry[1][0] > since]
+
+    def deletedSince(self, since):
+        return [key for version, key in self.deletions if version > since]
+
+    def json(self, key):
+        entry = self.__items.get(key)
+        return entry[1] if entry is not None else None
+
+    def bibTex(self, key):
+        entry = self.__items.get(key)
+        return entry[2] if entry is not None else None
+
+
+class FakeZoteroServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a user library with the given number of items, and the given number of group libraries
+    with groupItems items each"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, userId="123456", items=20000, groups=30, groupItems=1000, latency=0.0,
+                 throttleEvery=0, retryAfter=1, seed=42, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), FakeZoteroHandler)
+        self.latency = latency
+        self.throttleEvery = throttleEvery
+        self.retryAfter = retryAfter
+        rand = random.Random(seed)
+        letters = u"etaoinshrdlcumwfgypbvkjxqz"
+        words = [u"".join([rand.choice(letters) for _ in xrange(rand.randint(2, 11))]) for _ in xrange(5000)]
+        self.userId = userId
+        self.libraries = {("users", userId): FakeLibrary(userId, u"user", items, rand, words)}
+        self.groupIds = []
+        for number in xrange(groups):
+            groupId = str(100000 + number)
+            self.groupIds.append(groupId)
+            self.libraries[("groups", groupId)] = FakeLibrary(
+                groupId, u"group", groupItems, rand, words, firstKey=items + number * groupItems)
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.resetStats()
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    @property
+    def itemCount(self):
+        return sum([library.itemCount for library in self.libraries.values()])
+
+    def library(self, libType="users", libId=None):
+        return self.libraries[(libType, libId or self.userId)]
+
+    def modify(self, count, deleteCount=0, libType="users", libId=None):
+        """Changes count and deletes deleteCount items of a library, by default the user library"""
+        with self.__lock:
+            self.library(libType, libId).modify(count, deleteCount)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def resetStats(self):
+        self.requests = 0
+        self.throttled = 0
+        self.notModified = 0
+        self.bytesSent = 0
+
+    def count(self, attribute, amount=1):
+        with self.__lock:
+            setattr(self, attribute, getattr(self, attribute) + amount)
+            return getattr(self, attribute)
+
+
+class FakeZoteroHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        number = server.count("requests")
+        if server.latency > 0:
+            time.sleep(server.latency)
+        if server.throttleEvery > 0 and number % server.throttleEvery == 0:
+            server.count("throttled")
+            return self.__respond(429, "Too many requests", headers={"Retry-After": str(server.retryAfter)})
+        url = urlparse.urlparse(self.path)
+        query = dict([(name, values[-1]) for name, values in urlparse.parse_qs(url.query).items()])
+        parts = url.path.strip("/").split("/")
+        route = parts[2:]
+        if route == ["groups"] and parts[0] == "users":
+            # Like the real API, other users' groups are looked up by the same ID as the groups
+            return self.__groups(parts[1], query)
+        library = server.libraries.get(tuple(parts[:2]))
+        if library is None:
+            return self.__respond(404, "Not found")
+        if route == ["items", "top"]:
+            return self.__items(library, url.path, query)
+        if route == ["deleted"]:
+            return self.__deleted(library, query)
+        if route == ["items"] and "itemKey" in query:
+            return self.__itemSubset(library, url.path, query, query["itemKey"].split(","))
+        if len(route) == 2 and route[0] == "items":
+            return self.__item(library, route[1], query)
+        self.__respond(400, "Not supported by the fake Zotero server")
+
+    def __notModified(self, version):
+        since = self.headers.getheader("If-Modified-Since-Version")
+        if since is not None and int(since) >= version:
+            self.server.count("notModified")
+            self.__respond(304, "", headers={"Last-Modified-Version": str(version)})
+            return True
+        return False
+
+    def __page(self, path, query, objects):
+        """Responds with a page of JSON objects and the Link header to the other pages"""
+        limit = min(100, int(query.get("limit", 50)))
+        start = int(query.get("start", 0))
+        links = []
+        for rel, pageStart in (("next", start + limit), ("last", max(0, (len(objects) - 1) / limit * limit))):
+            if pageStart < len(objects) and (rel != "next" or pageStart > start):
+                linkQuery = dict(query)
+                linkQuery["start"] = str(pageStart)
+                links.append('<%s%s?%s>; rel="%s"' % (self.server.url, path, urllib.urlencode(linkQuery), rel))
+        return "[" + ",".join(objects[start:start + limit]) + "]", {
+            "Link": ", ".join(links), "Total-Results": str(len(objects))}
+
+    def __groups(self, userId, query):
+        if self.__notModified(1):
+            return
+        groups = []
+        if userId == self.server.userId:
+            groups = [json.dumps({u"id": int(groupId), u"version": 1, u"data": {u"id": int(groupId), u"name": u"Group %s" % groupId}})
+                      for groupId in self.server.groupIds]
+        body, headers = self.__page("/users/%s/groups" % userId, query, groups)
+        headers["Last-Modified-Version"] = "1"
+        self.__respond(200, body, "application/json", headers)
+
+    def __items(self, library, path, query):
+        if query.get("format", "json") != "json":
+            return self.__respond(400, "The fake Zotero server only serves pages of items as JSON")
+        if self.__notModified(library.version):
+            return
+        body, headers = self.__page(path, query, library.itemsSince(int(query.get("since", 0))))
+        headers["Last-Modified-Version"] = str(library.version)
+        self.__respond(200, body, "application/json", headers)
+
+    def __deleted(self, library, query):
+        deleted = {u"items": library.deletedSince(int(query.get("since", 0))),
+                   u"collections": [], u"searches": [], u"tags": [], u"settings": []}
+        self.__respond(200, json.dumps(deleted), "application/json", {"Last-Modified-Version": str(library.version)})
+
+    def __atomEntry(self, library, key):
+        bibTex = library.bibTex(key)
+        if bibTex is None:
+            return None
+        return (u'<entry><title>%s</title><id>http://zotero.org/%ss/%s/items/%s</id>'
+                u'<updated>2013-01-01T00:00:00Z</updated>'
+                u'<link rel="self" type="application/atom+xml" href=%s/>'
+                u'<zapi:key>%s</zapi:key><content type="text">%s</content></entry>') % (
+            key, library.libType, library.libId, key, quoteattr(self.server.url + self.path), key, escape(bibTex))
+
+    def __unsupportedFormat(self, query):
+        """Responds with 400 and returns True unless the format is JSON or Atom with BibTex content"""
+        format = query.get("format", "json")
+        if format == "json" or (format == "atom" and query.get("content") == "bibtex"):
+            return False
+        self.__respond(400, "The fake Zotero server only serves items as JSON or as Atom with content=bibtex")
+        return True
+
+    def __item(self, library, key, query):
+        if self.__unsupportedFormat(query):
+            return
+        if query.get("format", "json") == "json":
+            obj = library.json(key)
+            if obj is None:
+                return self.__respond(404, "Not found")
+            return self.__respond(200, obj, "application/json", {"Last-Modified-Version": str(library.version)})
+        entry = self.__atomEntry(library, key)
+        if entry is None:
+            return self.__respond(404, "Not found")
+        entry = entry.replace(u"<entry>", u'<entry xmlns="http://www.w3.org/2005/Atom" xmlns:zapi="http://zotero.org/ns/api">', 1)
+        self.__respond(200, u'<?xml version="1.0" encoding="UTF-8"?>' + entry, "application/atom+xml")
+
+    def __itemSubset(self, library, path, query, keys):
+        if self.__unsupportedFormat(query):
+            return
+        if query.get("format", "json") == "json":
+            objects = [obj for obj in [library.json(key) for key in keys] if obj is not None]
+            body, headers = self.__page(path, query, objects)
+            headers["Last-Modified-Version"] = str(library.version)
+            return self.__respond(200, body, "application/json", headers)
+        entries = [entry for entry in [self.__atomEntry(library, key) for key in keys] if entry is not None]
+        self.__respond(200, (
+            u'<?xml version="1.0" encoding="UTF-8"?>'
+            u'<feed xmlns="http://www.w3.org/2005/Atom" xmlns:zapi="http://zotero.org/ns/api">'
+            u'<title>Items</title><id>%s</id><link rel="self" type="application/atom+xml" href=%s/>'
+            u'<link rel="alternate" type="text/html" href=%s/><zapi:totalResults>%d</zapi:totalResults>%s</feed>') % (
+            escape(self.path), quoteattr(self.server.url + self.path), quoteattr(self.server.url + self.path),
+            len(entries), u"".join(entries)), "application/atom+xml")
+
+    def __respond(self, code, body, contentType="text/plain", headers=None):
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        self.send_response(code)
+        if code != 304:
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            if value:
+                self.send_header(name, value)
+        self.end_headers()
+        if code != 304:
+            self.wfile.write(body)
+            self.server.count("bytesSent", len(body))
@@ -0,0 +1,75 @@
+"""Measures the memory held by LibraryItems, in bytes per item, for a library of 50000 items
+with abstracts of random words. Run it with the Python 2 interpreter from the package folder:
+
+    python benchmarks/memory.py [numberOfItems]
+"""
+import os
+import sys
+import random
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+for lib in ("pyzotero", "feedparser", "pytz-2013b", "poster-0.8.1", "ordereddict-1.1"):
+    sys.path.append(os.path.join(root, "lib", lib))
+
+from library import LibraryItem
+
+
+def makeVocabulary(rand, size):
+    letters = u"etaoinshrdlcumwfgypbvkjxqz"
+    return [u"".join([rand.choice(letters) for _ in xrange(rand.randint(2, 11))]) for _ in xrange(size)]
+
+
+def makeItems(count):
+    rand = random.Random(42)
+    words = makeVocabulary(rand, 5000)
+    zotInstances = [(u"123456", u"user")] + [(unicode(groupId), u"group") for groupId in xrange(10)]
+    items = []
+    for i in xrange(count):
+        abstract = u" ".join([rand.choice(words) for _ in xrange(rand.randint(0, 250))])
+        items.append(LibraryItem(
+            u"%08X" % i,
+            # Every item gets its own tuple and year, as if decoded from Zotero
+            tuple(unicode(part) for part in rand.choice(zotInstances)),
+            u"; ".join([u"%s, %s" % (rand.choice(words).title(), rand.choice(words)[0].upper()) for _ in xrange(rand.randint(1, 4))]),
+            u" ".join([rand.choice(words) for _ in xrange(8)]).title(),
+            unicode(rand.randint(1950, 2013)),
+            abstract,
+            tags=u"; ".join([rand.choice(words) for _ in xrange(rand.randint(0, 3))])
+        ))
+    return items
+
+
+def sizeOf(obj, seen):
+    """Deep size of obj, not counting objects already seen"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum([sizeOf(value, seen) for value in obj])
+    elif hasattr(obj, "__dict__"):
+        size += sizeOf(obj.__dict__, seen)
+    elif isinstance(obj, dict):
+        size += sum([sizeOf(key, seen) + sizeOf(value, seen) for key, value in obj.items()])
+    if hasattr(type(obj), "__slots__"):
+        for slot in type(obj).__slots__:
+            if slot.startswith("__"):
+                slot = "_%s%s" % (type(obj).__name__, slot)
+            size += sizeOf(getattr(obj, slot, None), seen)
+    return size
+
+
+def main(count):
+    items = makeItems(count)
+    seen = set()
+    total = sum([sizeOf(item, seen) for item in items])
+    print "%d items: %d bytes per item" % (count, total / count)
+    for item in items:
+        item.menuRows
+    seen = set()
+    total = sum([sizeOf(item, seen) for item in items])
+    print "%d items with cached menu rows: %d bytes per item" % (count, total / count)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,26 @@
+"""Stand-in for the sublime module, so library.py can be imported outside of Sublime Text
+by the benchmarks"""
+import tempfile
+
+
+class Settings(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+__settings = {}
+
+
+def packages_path():
+    return tempfile.gettempdir()
+
+
+def load_settings(name):
+    return __settings.setdefault(name, Settings())
+
+
+def set_timeout(callback, delay):
+    callback()
+
+
+def status_message(message):
+    pass
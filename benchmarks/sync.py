@@ -0,0 +1,139 @@
+"""Times syncing a library with Zotero end to end, against the local stand-in for the Zotero API in
+fakezotero.py: the initial full sync, loading the synced library from the cache, the first search,
+a sync without changes, an incremental sync, citing items whose BibTex-entries have to be
+retrieved, and saving the BibTex-file. By default the library has 50000 items in a user library
+and 30 groups. Run it with the Python 2 interpreter from the package folder:
+
+    python benchmarks/sync.py [--items 20000] [--groups 30] [--group-items 1000] [--latency 0.05]
+
+The fake API is served over plain HTTP, so the connections aren't pooled like the ones to Zotero.
+Requests are paced like the real ones are, unless --unpaced is given.
+"""
+import os
+import sys
+import time
+import shutil
+import random
+import tempfile
+from optparse import OptionParser
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+for lib in ("pyzotero", "feedparser", "pytz-2013b", "poster-0.8.1", "ordereddict-1.1"):
+    sys.path.append(os.path.join(root, "lib", lib))
+
+import library
+from library import Library
+from pyzotero import zotero, keepalive, httpcache, scheduler
+from fakezotero import FakeZoteroServer
+
+
+class View(object):
+    """Stand-in for the Sublime Text view a library belongs to"""
+
+    def __init__(self, bufferId, fileName=None):
+        self.bufferId = bufferId
+        self.fileName = fileName
+
+    def buffer_id(self):
+        return self.bufferId
+
+    def file_name(self):
+        return self.fileName
+
+
+def useEndpoint(url):
+    """Makes all Zotero instances send their requests to url instead of the Zotero API"""
+    Zotero = zotero.Zotero
+
+    class LocalZotero(Zotero):
+        def __init__(self, *args, **kwargs):
+            Zotero.__init__(self, *args, **kwargs)
+            self.endpoint = url
+    zotero.Zotero = LocalZotero
+
+
+class Timer(object):
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+
+    def __enter__(self):
+        self.server.resetStats()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.time() - self.start
+        print "%-24s %8.3f s  %5d requests, %4d not modified, %3d throttled, %8d kB" % (
+            self.name + ":", self.seconds, self.server.requests, self.server.notModified, self.server.throttled,
+            self.server.bytesSent / 1024)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--items", type="int", default=20000, help="items of the user library")
+    parser.add_option("--groups", type="int", default=30, help="number of group libraries")
+    parser.add_option("--group-items", type="int", default=1000, help="items of each group library")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds every response is delayed")
+    parser.add_option("--throttle-every", type="int", default=0, help="answer every n-th request with 429")
+    parser.add_option("--retry-after", type="float", default=1, help="seconds a 429 asks to wait")
+    parser.add_option("--changes", type="int", default=500, help="items changed for the incremental sync")
+    parser.add_option("--cites", type="int", default=20, help="items cited one by one")
+    parser.add_option("--parallel", type="int", default=4, help="libraries synced in parallel")
+    parser.add_option("--unpaced", action="store_true", help="don't pace the requests")
+    options = parser.parse_args()[0]
+
+    server = FakeZoteroServer(items=options.items, groups=options.groups, groupItems=options.group_items,
+                              latency=options.latency, throttleEvery=options.throttle_every,
+                              retryAfter=options.retry_after)
+    server.start()
+    useEndpoint(server.url)
+    if options.unpaced:
+        scheduler.default.rate = scheduler.default.burst = 1e9
+    directory = tempfile.mkdtemp()
+    library.cache_folder = os.path.join(directory, "cache")
+    keepalive.register_openers(response_cache=httpcache.ResponseCache(os.path.join(library.cache_folder, "http")))
+    bibFile = os.path.join(directory, "document.bib")
+    view = View(1, os.path.join(directory, "document.tex"))
+    print "%d items in %d libraries, served from %s" % (server.itemCount, options.groups + 1, server.url)
+    try:
+        with Timer(server, "full sync"):
+            lib = Library(view, server.userId, "key", bibFile, False, options.parallel, 0)
+        itemCount = len(lib.LibraryItems)
+        lib.removeLibraryForView(False)
+        with Timer(server, "load from cache"):
+            lib = Library(view, server.userId, "key", bibFile, True, options.parallel, 0)
+            lib.LibraryItems
+        with Timer(server, "first search"):
+            # Waits for the search index, which is built in the background after loading
+            lib.search(u"the")
+        with Timer(server, "sync without changes"):
+            lib.update()
+        server.modify(options.changes)
+        with Timer(server, "incremental sync"):
+            lib.update()
+
+        rand = random.Random(42)
+        items = rand.sample(lib.LibraryItems, min(itemCount, options.cites))
+        latencies = []
+        with Timer(server, "cite %d items" % len(items)):
+            for item in items:
+                start = time.time()
+                lib.cite(item)
+                latencies.append(time.time() - start)
+        latencies.sort()
+        if latencies:
+            print "%-24s %8.3f s median, %.3f s max" % ("cite latency:", latencies[len(latencies) / 2], latencies[-1])
+        with Timer(server, "save %d citations" % len(items)):
+            lib.save()
+        with Timer(server, "save without changes"):
+            lib.save()
+        if itemCount != server.itemCount:
+            print "Warning: synced %d of %d items" % (itemCount, server.itemCount)
+    finally:
+        server.stop()
+        shutil.rmtree(directory, True)
+
+if __name__ == "__main__":
+    main()
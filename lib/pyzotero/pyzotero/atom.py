@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+atom.py
+
+Single-pass Atom reader for Zotero API responses
+
+This file is part of Pyzotero.
+
+Pyzotero is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pyzotero is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pyzotero. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+import time
+import calendar
+import xml.etree.ElementTree as et
+from StringIO import StringIO
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+ZAPI_NS = '{http://zotero.org/ns/api}'
+
+DATE = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?'
+    r'(Z|([+-])(\d\d):?(\d\d))?$')
+
+
+class FeedDict(dict):
+    """ dict which also allows attribute access, like feedparser's results
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def parse(source):
+    """
+    Parse an Atom feed or a single Atom entry in a single pass
+    Accepts a string or a file-like object, such as an HTTP response, which
+    is read incrementally. Returns a FeedDict with the same 'feed' and
+    'entries' structure feedparser.parse() returns for Zotero's feeds, and
+    the entries' zapi:etag attributes as 'etags'
+    """
+    if isinstance(source, basestring):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        source = StringIO(source)
+    feed = FeedDict(links=[])
+    entries = []
+    root = None
+    depth = 0
+    for event, elem in et.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and root.tag == ATOM_NS + 'feed':
+            # the feed's children are done with once they've ended, so
+            # they're dropped to keep memory flat for large pages
+            if elem.tag == ATOM_NS + 'entry':
+                entries.append(_entry(elem))
+            else:
+                _field(feed, elem)
+            root.remove(elem)
+        elif depth == 0 and root.tag == ATOM_NS + 'entry':
+            # a single entry, e.g. a created item
+            entries.append(_entry(elem))
+    etags = [entry.get('zapi_etag') for entry in entries]
+    return FeedDict(
+        feed=feed,
+        entries=entries,
+        etags=None if None in etags else etags)
+
+
+def _entry(elem):
+    """ Return the feedparser-like dict of an Atom entry element
+    """
+    entry = FeedDict(links=[])
+    for child in elem:
+        if child.tag == ATOM_NS + 'content':
+            entry['content'] = [FeedDict(
+                type=child.get('type', 'text'),
+                value=_content(child))]
+            etag = child.get(ZAPI_NS + 'etag')
+            if etag is not None:
+                entry['zapi_etag'] = etag
+        elif child.tag == ATOM_NS + 'author':
+            name = child.find(ATOM_NS + 'name')
+            if name is not None:
+                entry['author'] = name.text or u''
+        else:
+            _field(entry, child)
+    return entry
+
+
+def _field(target, elem):
+    """ Add a child element of a feed or an entry to its dict
+    """
+    if elem.tag == ATOM_NS + 'link':
+        link = FeedDict(
+            rel=elem.get('rel', 'alternate'),
+            type=elem.get('type'),
+            href=elem.get('href'))
+        target['links'].append(link)
+        if link['rel'] == 'alternate':
+            target['link'] = link['href']
+    elif elem.tag.startswith(ATOM_NS):
+        name = elem.tag[len(ATOM_NS):]
+        target[name] = _text(elem)
+        if name in ('updated', 'published'):
+            target[name + '_parsed'] = _parse_date(target[name])
+    elif elem.tag.startswith(ZAPI_NS):
+        target['zapi_' + elem.tag[len(ZAPI_NS):].lower()] = _text(elem)
+
+
+def _text(elem):
+    text = elem.text or u''
+    return unicode(text.strip())
+
+
+def _content(elem):
+    """ The value of a content element; the markup inside the wrapping div
+        of XHTML content, the text otherwise
+    """
+    if elem.get('type') != 'xhtml':
+        return unicode(elem.text or u'')
+    children = list(elem)
+    if not children:
+        return u''
+    wrapper = children[0]
+    parts = [_escape(wrapper.text or u'')]
+    for child in wrapper:
+        _serialize(child, parts)
+    return u''.join(parts).strip()
+
+
+def _serialize(elem, parts):
+    """ Serialize an XHTML element, including its tail, without namespaces
+    """
+    tag = _local(elem.tag)
+    parts.append(u'<' + tag)
+    for name, value in sorted(elem.attrib.items()):
+        parts.append(u' %s="%s"' % (
+            _local(name), _escape(value).replace(u'"', u'&quot;')))
+    if elem.text or len(elem):
+        parts.append(u'>' + _escape(elem.text or u''))
+        for child in elem:
+            _serialize(child, parts)
+        parts.append(u'</%s>' % tag)
+    else:
+        parts.append(u' />')
+    parts.append(_escape(elem.tail or u''))
+
+
+def _local(name):
+    return name.split('}', 1)[-1]
+
+
+def _escape(text):
+    return unicode(text).replace(u'&', u'&amp;').replace(
+        u'<', u'&lt;').replace(u'>', u'&gt;')
+
+
+def _parse_date(text):
+    """ Parse an RFC 3339 date into a UTC time.struct_time
+    """
+    match = DATE.match(text)
+    if not match:
+        return None
+    fields = [int(field) for field in match.groups()[:6]]
+    timestamp = calendar.timegm(fields + [0, 0, 0])
+    if match.group(8):
+        offset = int(match.group(9)) * 3600 + int(match.group(10)) * 60
+        timestamp += -offset if match.group(8) == '+' else offset
+    return time.gmtime(timestamp)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+compression.py
+
+Transparent gzip and deflate compressed transfers for urllib2
+
+This file is part of Pyzotero.
+
+Pyzotero is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pyzotero is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pyzotero. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import urllib2
+import zlib
+import threading
+
+
+class TransferStats(object):
+    """ Byte counters of the responses handled by a DecompressionProcessor
+        received is what was transferred, decoded what it decompressed to
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Set all counters to zero
+        """
+        with self._lock:
+            self.uncompressed_responses = 0
+            self.compressed_responses = 0
+            self.received = 0
+            self.decoded = 0
+
+    def add(self, received, decoded):
+        """ Count a completely read compressed response
+        """
+        with self._lock:
+            self.compressed_responses += 1
+            self.received += received
+            self.decoded += decoded
+
+    def add_uncompressed(self):
+        """ Count a response which wasn't compressed
+        """
+        with self._lock:
+            self.uncompressed_responses += 1
+
+    @property
+    def saved(self):
+        """ Bytes which didn't have to be transferred
+        """
+        return self.decoded - self.received
+
+
+class DecompressingFile(object):
+    """ File-like object decompressing a gzip or deflate encoded stream
+        chunk by chunk while it's read
+    """
+    chunk_size = 16384
+
+    def __init__(self, fp, encoding, stats):
+        self._fp = fp
+        self._encoding = encoding
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zlib.decompressobj()
+        self._stats = stats
+        self._buffer = ''
+        self._received = 0
+        self._decoded = 0
+        self._eof = False
+
+    def _decompress_chunk(self):
+        """ Read and decompress the next chunk of the stream
+        """
+        chunk = self._fp.read(self.chunk_size)
+        if not chunk:
+            data = self._decompressor.flush()
+            self._eof = True
+            self._decoded += len(data)
+            self._stats.add(self._received, self._decoded)
+            return data
+        self._received += len(chunk)
+        try:
+            data = self._decompressor.decompress(chunk)
+        except zlib.error:
+            if self._encoding != 'deflate' or self._received != len(chunk):
+                raise
+            # some servers send raw deflate streams, without zlib header
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self._decompressor.decompress(chunk)
+        self._decoded += len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            pieces = [self._buffer]
+            while not self._eof:
+                pieces.append(self._decompress_chunk())
+            self._buffer = ''
+            return ''.join(pieces)
+        while len(self._buffer) < size and not self._eof:
+            self._buffer += self._decompress_chunk()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while '\n' not in self._buffer and not self._eof:
+            self._buffer += self._decompress_chunk()
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def close(self):
+        self._fp.close()
+
+
+class DecompressionProcessor(urllib2.BaseHandler):
+    """ Ask for compressed responses and decompress them while they're read
+    """
+    # run before HTTPErrorProcessor, so error bodies are decompressed too
+    handler_order = 900
+
+    def __init__(self, transfer_stats=None):
+        if transfer_stats is None:
+            transfer_stats = stats
+        self.stats = transfer_stats
+
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-Encoding', 'gzip, deflate')
+        return req
+
+    def http_response(self, req, response):
+        try:
+            encoding = response.info().getheader('Content-Encoding')
+        except AttributeError:
+            # responses without parsed headers
+            encoding = None
+        encoding = (encoding or '').strip().lower()
+        if encoding not in ('gzip', 'x-gzip', 'deflate'):
+            self.stats.add_uncompressed()
+            return response
+        if encoding == 'x-gzip':
+            encoding = 'gzip'
+        decompressed = urllib2.addinfourl(
+            DecompressingFile(response, encoding, self.stats),
+            response.info(),
+            response.geturl())
+        decompressed.code = response.code
+        decompressed.msg = response.msg
+        return decompressed
+
+    https_request = http_request
+    https_response = http_response
+
+
+stats = TransferStats()
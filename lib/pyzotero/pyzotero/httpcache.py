@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+httpcache.py
+
+On-disk cache of API responses, revalidated with conditional requests
+
+This file is part of Pyzotero.
+
+Pyzotero is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pyzotero is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pyzotero. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import urllib2
+import httplib
+import hashlib
+import threading
+import cPickle
+import tempfile
+import urlparse
+from StringIO import StringIO
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+# response header -> request header revalidating it
+VALIDATORS = (
+    ('ETag', 'If-None-Match'),
+    ('Last-Modified', 'If-Modified-Since'),
+    ('Last-Modified-Version', 'If-Modified-Since-Version'))
+
+# these describe the transfer, not the cached body
+TRANSFER_HEADERS = frozenset(
+    ['content-encoding', 'content-length', 'transfer-encoding', 'connection'])
+
+
+class ResponseCache(object):
+    """
+    Response bodies and headers by URL, one file each in directory
+    When the files exceed max_bytes together, the least recently used ones
+    are removed. The API key is left out of the URLs, so it's never written
+    to disk; the server checks it when the response is revalidated
+    A file holds the pickled URL and headers, followed by the body
+    """
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # file name -> size, least recently used first
+        self._sizes = OrderedDict()
+        self._total = 0
+        if os.path.isdir(directory):
+            files = []
+            for name in os.listdir(directory):
+                if name.endswith('.response'):
+                    stat = os.stat(os.path.join(directory, name))
+                    files.append((stat.st_mtime, name, stat.st_size))
+            for _, name, size in sorted(files):
+                self._sizes[name] = size
+                self._total += size
+
+    @staticmethod
+    def _without_key(url):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        query = '&'.join([param for param in query.split('&')
+            if param.split('=', 1)[0] != 'key'])
+        return urlparse.urlunsplit((scheme, netloc, path, query, fragment))
+
+    @staticmethod
+    def _name(url):
+        return hashlib.sha1(url).hexdigest() + '.response'
+
+    def get(self, url):
+        """ Return the cached (headers, body) of the URL, or None
+        """
+        url = self._without_key(url)
+        name = self._name(url)
+        with self._lock:
+            if name not in self._sizes:
+                return None
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                cached = cPickle.load(f)
+                if cached.get('url') != url:
+                    return None
+                return cached['headers'], f.read()
+        except Exception:
+            # unpickling a damaged file can raise about anything
+            self._forget(name)
+            return None
+
+    def put(self, url, headers, body):
+        """ Store the headers, a string, and body of the URL's response
+        """
+        writer = self.writer(url, headers)
+        if writer is not None:
+            writer.write(body)
+            writer.commit()
+
+    def writer(self, url, headers):
+        """ Return a CacheWriter storing the URL's response, whose body is
+            written to it piece by piece, or None if the cache can't be
+            written to
+        """
+        url = self._without_key(url)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            handle, temp_path = tempfile.mkstemp('.tmp', '', self.directory)
+            f = os.fdopen(handle, 'wb')
+        except (IOError, OSError):
+            # caching is an optimisation only
+            return None
+        writer = CacheWriter(self, self._name(url), f, temp_path)
+        cPickle.dump({'url': url, 'headers': headers}, writer,
+            cPickle.HIGHEST_PROTOCOL)
+        return writer
+
+    def _stored(self, name, temp_path):
+        """ Replace the cached file of name by the one written to temp_path
+        """
+        path = os.path.join(self.directory, name)
+        try:
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+            size = os.path.getsize(path)
+        except (IOError, OSError):
+            _remove_file(temp_path)
+            return
+        with self._lock:
+            self._total += size - self._sizes.pop(name, 0)
+            self._sizes[name] = size
+            evicted = []
+            while self._total > self.max_bytes and len(self._sizes) > 1:
+                old_name, old_size = self._sizes.popitem(last=False)
+                self._total -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            self._remove(old_name)
+
+    def touch(self, url):
+        """ Mark the URL's response as recently used
+        """
+        name = self._name(self._without_key(url))
+        with self._lock:
+            if name not in self._sizes:
+                return
+            self._sizes[name] = self._sizes.pop(name)
+        try:
+            os.utime(os.path.join(self.directory, name), None)
+        except OSError:
+            pass
+
+    def _forget(self, name):
+        with self._lock:
+            self._total -= self._sizes.pop(name, 0)
+        self._remove(name)
+
+    def _remove(self, name):
+        _remove_file(os.path.join(self.directory, name))
+
+
+class CacheWriter(object):
+    """ Writes a response to a temporary file, which replaces the cached
+        response once it's committed
+    """
+    def __init__(self, cache, name, f, temp_path):
+        self._cache = cache
+        self._name = name
+        self._file = f
+        self._temp_path = temp_path
+
+    def write(self, data):
+        if self._file is None:
+            return
+        try:
+            self._file.write(data)
+        except (IOError, OSError):
+            self.abort()
+
+    def commit(self):
+        """ Store the response written so far in the cache
+        """
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except (IOError, OSError):
+            self.abort()
+            return
+        self._file = None
+        self._cache._stored(self._name, self._temp_path)
+
+    def abort(self):
+        """ Drop the response written so far
+        """
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except (IOError, OSError):
+            pass
+        self._file = None
+        _remove_file(self._temp_path)
+
+
+class CachingFile(object):
+    """ File-like object passing a response body through while it's read,
+        and writing it to a CacheWriter. The response is cached once its
+        body was read completely, and dropped if it's closed before
+    """
+    def __init__(self, fp, writer):
+        self._fp = fp
+        self._writer = writer
+
+    def _passed(self, data, eof):
+        if self._writer is not None:
+            self._writer.write(data)
+            if eof:
+                self._writer.commit()
+                self._writer = None
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._passed(self._fp.read(), True)
+        data = self._fp.read(size)
+        return self._passed(data, not data)
+
+    def readline(self, size=-1):
+        data = self._fp.readline(size)
+        return self._passed(data, not data)
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+        self._fp.close()
+
+
+class ConditionalGetProcessor(urllib2.BaseHandler):
+    """
+    Revalidate cached GET responses with their validators, and answer
+    304 Not Modified responses from the cache, as if the server had sent
+    the body again. Responses served from the cache have from_cache set
+    Bodies are cached while they're read, so they're still streamed. Pages
+    following the first one of a listing aren't cached, as they're only
+    requested again if the first page changed, and then with other
+    parameters
+    """
+    # after DecompressionProcessor, so the bodies are cached decompressed,
+    # and before HTTPErrorProcessor, which would raise for 304
+    handler_order = 950
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def http_request(self, req):
+        if req.get_method() != 'GET':
+            return req
+        cached = self.cache.get(req.get_full_url())
+        if cached is None:
+            return req
+        headers = _message(cached[0])
+        for response_header, request_header in VALIDATORS:
+            value = headers.getheader(response_header)
+            if value is not None and not req.has_header(
+                    request_header.capitalize()):
+                req.add_unredirected_header(request_header, value)
+        # the response processor shouldn't need to read it again
+        req.cached_response = cached
+        return req
+
+    def http_response(self, req, response):
+        if req.get_method() != 'GET':
+            return response
+        cached = getattr(req, 'cached_response', None)
+        if response.code == 304 and cached is not None:
+            response.close()
+            self.cache.touch(req.get_full_url())
+            return _response(req, cached[0], cached[1], True)
+        if response.code != 200:
+            return response
+        headers = response.info()
+        if not hasattr(headers, 'getheader') or not [
+                h for h, _ in VALIDATORS if headers.getheader(h) is not None]:
+            return response
+        if _follow_up_page(req.get_full_url()):
+            return response
+        writer = self.cache.writer(req.get_full_url(), ''.join(
+            [line for line in headers.headers if line.split(':', 1)[0]
+                .strip().lower() not in TRANSFER_HEADERS]))
+        if writer is None:
+            return response
+        teed = urllib2.addinfourl(CachingFile(response, writer), headers,
+            response.geturl())
+        teed.code = response.code
+        teed.msg = response.msg
+        teed.from_cache = False
+        return teed
+
+    https_request = http_request
+    https_response = http_response
+
+
+def _follow_up_page(url):
+    start = urlparse.parse_qs(urlparse.urlsplit(url)[3]).get('start')
+    return start is not None and start[-1] not in ('', '0')
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _message(headers):
+    return httplib.HTTPMessage(StringIO(headers))
+
+
+def _response(req, headers, body, from_cache):
+    response = urllib2.addinfourl(
+        StringIO(body), _message(headers), req.get_full_url())
+    response.code = 200
+    response.msg = 'OK'
+    response.from_cache = from_cache
+    return response
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+keepalive.py
+
+Persistent, pooled HTTPS connections for urllib2
+
+This file is part of Pyzotero.
+
+Pyzotero is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pyzotero is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pyzotero. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import urllib
+import urllib2
+import httplib
+import socket
+import threading
+from poster.streaminghttp import get_handlers
+import compression
+import httpcache
+
+
+class ConnectionPool(object):
+    """ Idle HTTPS connections, by host. At most max_connections idle
+        connections are kept per host, further ones are closed once
+        their response was read
+    """
+    def __init__(self, max_connections=4,
+            connection_class=httplib.HTTPSConnection):
+        self.max_connections = max_connections
+        self.connection_class = connection_class
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, timeout):
+        """ Return an idle connection to host, or a new one if there's
+            none, and whether it was reused
+        """
+        with self._lock:
+            idle = self._idle.get(host)
+            if idle:
+                return idle.pop(), True
+        return self.connection_class(host, timeout=timeout), False
+
+    def put(self, host, connection):
+        """ Return a connection to the pool once its response was read
+        """
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.max_connections:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close_all(self):
+        """ Close all idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class KeepAliveHTTPSHandler(urllib2.HTTPSHandler):
+    """ HTTPS handler reusing the connections of a ConnectionPool
+        Requests streaming their data, such as file uploads, and requests
+        through a proxy are left to the handlers following this one
+    """
+    # run before poster's streaming handler
+    handler_order = 400
+    # requests which may be sent again if a reused connection turns out
+    # to be closed, as sending them twice has no further effect
+    idempotent_methods = frozenset(['GET', 'HEAD'])
+
+    def __init__(self, pool):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def https_open(self, req):
+        data = req.get_data()
+        if data is not None and not isinstance(data, basestring):
+            return None
+        # tunnelled through a proxy, pooled by the proxy's host otherwise
+        if req.has_proxy() or getattr(req, '_tunnel_host', None):
+            return None
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update(
+            (k, v) for k, v in req.headers.items() if k not in headers)
+        headers['Connection'] = 'keep-alive'
+        headers = dict(
+            (name.title(), value) for name, value in headers.items())
+        connection, reused = self.pool.get(host, req.timeout)
+        try:
+            response = self._request(connection, req, data, headers)
+        except (socket.error, httplib.HTTPException), error:
+            connection.close()
+            if not reused or req.get_method() not in self.idempotent_methods:
+                raise urllib2.URLError(error)
+            # the server closed the idle connection in the meantime
+            connection = self.pool.connection_class(host, timeout=req.timeout)
+            try:
+                response = self._request(connection, req, data, headers)
+            except (socket.error, httplib.HTTPException), error:
+                connection.close()
+                raise urllib2.URLError(error)
+        resp = urllib.addinfourl(
+            PooledResponseFile(response, self.pool, host, connection),
+            response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    @staticmethod
+    def _request(connection, req, data, headers):
+        """ Send the request and read the response's status and headers
+            Only failing this far is retried, the body is read by the caller
+        """
+        connection.request(req.get_method(), req.get_selector(), data, headers)
+        return connection.getresponse()
+
+
+class PooledResponseFile(object):
+    """ File-like object streaming the body of a response, which returns the
+        connection to the pool once the body was read completely. Closing it
+        before, or failing to read the body, closes the connection, as the
+        rest of the body would still be waiting on it
+    """
+    def __init__(self, response, pool, host, connection):
+        self._response = response
+        self._pool = pool
+        self._host = host
+        self._connection = connection
+        self._buffer = ''
+        if response.isclosed():
+            # nothing to read, such as the responses to HEAD requests
+            self._release()
+
+    def _release(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if self._response.will_close:
+            connection.close()
+        else:
+            self._pool.put(self._host, connection)
+
+    def _drop(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            connection.close()
+
+    def _read(self, size):
+        try:
+            # HTTPResponse reads up to the end for a size of None only
+            data = self._response.read(size)
+        except:
+            self._response.close()
+            self._drop()
+            raise
+        if size is None or not data or self._response.isclosed():
+            self._release()
+        return data
+
+    def read(self, size=-1):
+        buffered, self._buffer = self._buffer, ''
+        if size is None or size < 0:
+            return buffered + self._read(None)
+        if len(buffered) >= size:
+            self._buffer = buffered[size:]
+            return buffered[:size]
+        return buffered + self._read(size - len(buffered))
+
+    def readline(self, size=-1):
+        line = self._buffer
+        while '\n' not in line and (size < 0 or len(line) < size):
+            data = self._read(8192)
+            if not data:
+                break
+            line += data
+        end = line.find('\n') + 1 or len(line)
+        if size >= 0:
+            end = min(end, size)
+        line, self._buffer = line[:end], line[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def close(self):
+        self._response.close()
+        self._drop()
+
+
+pool = ConnectionPool()
+
+
+def register_openers(max_connections=None, response_cache=None):
+    """ Register the keep-alive HTTPS handler, backed by the shared
+        connection pool, and the decompression of compressed responses in the
+        global urllib2 default opener object. Poster's streaming handlers are
+        registered as well, for file uploads.
+        max_connections sets the number of idle connections kept per host
+        Given an httpcache.ResponseCache, GET requests are revalidated with
+        the validators of the cached responses
+
+        Returns the created OpenerDirector object.
+    """
+    if max_connections is not None:
+        pool.max_connections = max_connections
+    handlers = [KeepAliveHTTPSHandler(pool),
+        compression.DecompressionProcessor()]
+    if response_cache is not None:
+        handlers.append(httpcache.ConditionalGetProcessor(response_cache))
+    handlers.extend(get_handlers())
+    opener = urllib2.build_opener(*handlers)
+    urllib2.install_opener(opener)
+    return opener
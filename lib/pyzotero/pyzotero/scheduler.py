@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+scheduler.py
+
+Rate-limit aware scheduling of Zotero API requests
+
+This file is part of Pyzotero.
+
+Pyzotero is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pyzotero is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pyzotero. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import urllib2
+import time
+import random
+import threading
+import calendar
+from email.utils import parsedate_tz
+
+
+class RequestScheduler(object):
+    """
+    Opens requests on behalf of all Zotero instances
+    Requests are paced by a token bucket per API key, and delayed for as
+    long as the API asked to in its Backoff and Retry-After headers.
+    Idempotent requests failing with 429, 502, 503, 504 or a connection
+    error are retried with jittered exponential backoff
+    """
+    retry_codes = frozenset([429, 502, 503, 504])
+    idempotent_methods = frozenset(['GET', 'HEAD'])
+
+    def __init__(self, rate=20.0, burst=20, max_retries=5, base_delay=1.0,
+            max_delay=60.0, sleep=time.sleep, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._sleep = sleep
+        self._clock = clock
+        # api key -> [available tokens, time they were counted]
+        self._buckets = {}
+        # api key -> time before which no request may be sent
+        self._not_before = {}
+        self._lock = threading.Lock()
+
+    def open(self, request, api_key=None):
+        """ Open the urllib2 request once the rate limits permit, retrying it
+            if possible. Errors which can't be retried are raised as is
+        """
+        attempt = 0
+        while True:
+            self.wait(api_key)
+            try:
+                response = urllib2.urlopen(request)
+            except urllib2.HTTPError, error:
+                delay = retry_after(error, self._clock())
+                if delay is not None:
+                    self.defer(api_key, delay)
+                if not self._retry(request, error.code, attempt):
+                    raise
+                if delay is None:
+                    self.defer(api_key, self._backoff(attempt))
+            except urllib2.URLError:
+                if not self._retry(request, None, attempt):
+                    raise
+                self.defer(api_key, self._backoff(attempt))
+            else:
+                backoff = header_seconds(response, 'Backoff')
+                if backoff is not None:
+                    self.defer(api_key, backoff)
+                return response
+            attempt += 1
+
+    def wait(self, api_key=None):
+        """ Block until a request may be sent with the API key
+        """
+        while True:
+            with self._lock:
+                now = self._clock()
+                delay = self._not_before.get(api_key, 0) - now
+                if delay <= 0:
+                    tokens, counted = self._buckets.get(
+                        api_key, (self.burst, now))
+                    tokens = min(
+                        self.burst, tokens + (now - counted) * self.rate)
+                    if tokens >= 1:
+                        self._buckets[api_key] = [tokens - 1, now]
+                        return
+                    delay = (1 - tokens) / self.rate
+            self._sleep(delay)
+
+    def defer(self, api_key, seconds):
+        """ Send no requests with the API key for the given seconds
+        """
+        with self._lock:
+            not_before = self._clock() + seconds
+            if not_before > self._not_before.get(api_key, 0):
+                self._not_before[api_key] = not_before
+
+    def _retry(self, request, code, attempt):
+        return request.get_method() in self.idempotent_methods and \
+            (code is None or code in self.retry_codes) and \
+            attempt < self.max_retries
+
+    def _backoff(self, attempt):
+        """ Exponential backoff with full jitter
+        """
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def header_seconds(response, header):
+    """ Return a header's value as seconds, or None if it isn't present
+    """
+    try:
+        value = response.info().getheader(header)
+    except AttributeError:
+        # responses without parsed headers
+        return None
+    try:
+        return max(0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(error, now):
+    """ Return the seconds to wait according to the Retry-After header of an
+        HTTPError, given in seconds or as an HTTP date, or None
+    """
+    seconds = header_seconds(error, 'Retry-After')
+    if seconds is not None:
+        return seconds
+    try:
+        value = error.info().getheader('Retry-After')
+    except AttributeError:
+        return None
+    date = value and parsedate_tz(value)
+    if not date:
+        return None
+    return max(0, calendar.timegm(date[:9]) - (date[9] or 0) - now)
+
+
+default = RequestScheduler()
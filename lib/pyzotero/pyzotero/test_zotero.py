@@ -21,18 +21,36 @@ You should have received a copy of the GNU General Public License
 along with Pyzotero. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
+import sys
+import subprocess
 import unittest
 import zotero as z
+import keepalive
+import atom
+import scheduler
+import feedparser
+import compression
+import httpcache
+import gzip
+import shutil
+import tempfile
 import urllib2
+import httplib
 from StringIO import StringIO
 
 
 
-def mock_response(req, resp_obj, resp_code):
+def mock_response(req, resp_obj, resp_code, resp_headers=None):
     """ Mock response for MyHTTPSHandler
     """
+    if resp_headers:
+        headers = httplib.HTTPMessage(StringIO(''.join(
+            ['%s: %s\r\n' % h for h in resp_headers.items()])))
+    else:
+        headers = 'This is a mocked URI!'
     resp = urllib2.addinfourl(StringIO(resp_obj),
-    'This is a mocked URI!',
+    headers,
     req.get_full_url())
     resp.code = resp_code
     resp.msg = "OK"
@@ -44,16 +62,60 @@ class MyHTTPSHandler(urllib2.HTTPSHandler):
         takes 2 arguments: a string or a reference to a file, and response code
         this is what's returned by .read()
     """
-    def __init__(self, resp_obj, resp_code = None):
+    def __init__(self, resp_obj, resp_code = None, resp_headers = None):
         self.resp_obj = resp_obj
         if not resp_code:
             self.resp_code = 200
         else: self.resp_code = resp_code
+        self.resp_headers = resp_headers
     # Change HTTPSHandler and https_open to http for non-https calls
     def https_open(self, req):
-        return mock_response(req, self.resp_obj, self.resp_code)
+        return mock_response(
+            req, self.resp_obj, self.resp_code, self.resp_headers)
 
 
+class MySequenceHTTPSHandler(urllib2.HTTPSHandler):
+    """ Mock response for urllib2, returning one (body, code, headers) tuple
+        of the given list per request
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+        self.sent = []
+
+    def https_open(self, req):
+        self.requests += 1
+        self.sent.append(req)
+        return mock_response(req, *self.responses.pop(0))
+
+
+class MyHTTPSConnection(object):
+    """ Mock connection for keepalive.ConnectionPool, answering every
+        request with a 200 response
+    """
+    opened = []
+
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.requests = []
+        self.closed = False
+        MyHTTPSConnection.opened.append(self)
+
+    def request(self, method, selector, data=None, headers=None):
+        self.requests.append((method, selector, headers))
+
+    def getresponse(self):
+        resp = StringIO('Response %s' % len(self.requests))
+        resp.status = 200
+        resp.reason = 'OK'
+        resp.msg = httplib.HTTPMessage(StringIO('Last-Modified-Version: 5\r\n'))
+        resp.will_close = False
+        resp.isclosed = lambda: resp.closed
+        return resp
+
+    def close(self):
+        self.closed = True
+
 
 class ZoteroTests(unittest.TestCase):
     """ Tests for pyzotero
@@ -417,6 +479,7 @@ class ZoteroTests(unittest.TestCase):
         }
         ]"""
         self.keys_response = """ABCDE\nFGHIJ\nKLMNO\n"""
+        self.deleted_response = """{"collections":[],"items":["ABCD2345","BCDE3456"],"searches":[],"tags":[]}"""
         # Add the item file to the mock response by default
         my_opener = urllib2.build_opener(MyHTTPSHandler(self.items_doc))
         z.urllib2.install_opener(my_opener)
@@ -679,6 +742,434 @@ class ZoteroTests(unittest.TestCase):
         self.assertEqual(z.etags(self.items_doc),
                 ['7252daf2495feb8ec89c61f391bcba24'])
 
+    def testLibraryVersion(self):
+        """ Should send the API version header and remember the library
+            version returned by the server
+        """
+        my_opener = urllib2.build_opener(MyHTTPSHandler(
+            self.items_doc, 200, {'Last-Modified-Version': '1234'}))
+        z.urllib2.install_opener(my_opener)
+        zot = z.Zotero('myuserID', 'users', 'myuserkey', api_version=2)
+        self.assertEqual(None, zot.library_version)
+        zot.top(newer=1000)
+        self.assertEqual('1234', zot.library_version)
+        self.assertEqual(2, zot.request.get_header('Zotero-api-version'))
+        self.assertIn('newer=1000', zot.request.get_full_url())
+
+    def testParseDeleted(self):
+        """ Should return the deleted keys since the given library version
+        """
+        my_opener = urllib2.build_opener(MyHTTPSHandler(
+            self.deleted_response, 200))
+        z.urllib2.install_opener(my_opener)
+        zot = z.Zotero('myuserID', 'users', 'myuserkey', api_version=2)
+        deleted = zot.deleted(newer=1000)
+        self.assertEqual([u'ABCD2345', u'BCDE3456'], deleted['items'])
+        self.assertIn('/myuserID/deleted?', zot.request.get_full_url())
+        self.assertIn('newer=1000', zot.request.get_full_url())
+        self.assertNotIn('content=', zot.request.get_full_url())
+        self.assertEqual(None, zot.url_params)
+
+    def testGetSubset(self):
+        """ Should retrieve all items of a subset with a single request and
+            remember the keys of the returned items
+        """
+        my_opener = urllib2.build_opener(MyHTTPSHandler(self.bib_doc))
+        z.urllib2.install_opener(my_opener)
+        zot = z.Zotero('myuserID', 'users', 'myuserkey')
+        items_data = zot.get_subset(['T4AH4RZA', 'abcd1234'], content='bib')
+        self.assertIn('itemKey=T4AH4RZA%2CABCD1234', zot.request.get_full_url())
+        self.assertIn('content=bib', zot.request.get_full_url())
+        self.assertEqual([u'T4AH4RZA'], zot.item_keys)
+        self.assertTrue(items_data[0].startswith("""<div class="csl-entry">"""))
+        with self.assertRaises(z.ze.TooManyItems):
+            zot.get_subset(['ABCD1234'] * 51)
+
+    def testKeepAliveReusesConnections(self):
+        """ Subsequent requests to the same host should be sent over the same
+            pooled connection
+        """
+        MyHTTPSConnection.opened = []
+        pool = keepalive.ConnectionPool(1, MyHTTPSConnection)
+        my_opener = urllib2.build_opener(keepalive.KeepAliveHTTPSHandler(pool))
+        z.urllib2.install_opener(my_opener)
+        zot = z.Zotero('myuserID', 'users', 'myuserkey')
+        self.assertEqual('Response 1', zot._retrieve_data('/users/myuserID/items'))
+        self.assertEqual('Response 2', zot._retrieve_data('/users/myuserID/tags'))
+        self.assertEqual('5', zot.library_version)
+        self.assertEqual(1, len(MyHTTPSConnection.opened))
+        connection = MyHTTPSConnection.opened[0]
+        self.assertEqual('api.zotero.org', connection.host)
+        self.assertEqual('/users/myuserID/tags', connection.requests[1][1])
+        self.assertEqual('keep-alive', connection.requests[1][2]['Connection'])
+        pool.close_all()
+        self.assertTrue(connection.closed)
+
+    def testKeepAliveRetriesOnlyIdempotentRequests(self):
+        """ A reused connection closed by the server should be replaced for
+            GET requests, but not for POST requests, which the server might
+            have processed already
+        """
+        class ClosedHTTPSConnection(MyHTTPSConnection):
+            def getresponse(self):
+                raise httplib.BadStatusLine('')
+        pool = keepalive.ConnectionPool(2, MyHTTPSConnection)
+        my_opener = urllib2.build_opener(keepalive.KeepAliveHTTPSHandler(pool))
+        for data, retried in ((None, True), ('{}', False)):
+            MyHTTPSConnection.opened = []
+            pool._idle = {'api.zotero.org': [ClosedHTTPSConnection('api.zotero.org')]}
+            req = urllib2.Request('https://api.zotero.org/users/myuserID/items', data)
+            if retried:
+                self.assertEqual('Response 1', my_opener.open(req).read())
+            else:
+                self.assertRaises(urllib2.URLError, my_opener.open, req)
+            self.assertEqual(retried and 2 or 1, len(MyHTTPSConnection.opened))
+            self.assertTrue(MyHTTPSConnection.opened[0].closed)
+
+    def testKeepAliveStreamsResponses(self):
+        """ A connection should be returned to the pool once its response
+            was read completely, and closed if the response is closed before
+        """
+        MyHTTPSConnection.opened = []
+        pool = keepalive.ConnectionPool(2, MyHTTPSConnection)
+        my_opener = urllib2.build_opener(keepalive.KeepAliveHTTPSHandler(pool))
+        url = 'https://api.zotero.org/users/myuserID/items'
+        response = my_opener.open(url)
+        self.assertEqual({}, pool._idle)
+        self.assertEqual('Response', response.readline(8))
+        self.assertEqual({}, pool._idle)
+        self.assertEqual(' 1', response.read(10))
+        connection = MyHTTPSConnection.opened[0]
+        self.assertEqual([connection], pool._idle['api.zotero.org'])
+        response = my_opener.open(url)
+        self.assertEqual('Resp', response.read(4))
+        response.close()
+        self.assertTrue(connection.closed)
+        self.assertEqual([], pool._idle['api.zotero.org'])
+        self.assertEqual(1, len(MyHTTPSConnection.opened))
+
+    def testKeepAliveLeavesProxiedRequests(self):
+        """ Requests through a proxy should be left to the following handlers
+        """
+        pool = keepalive.ConnectionPool(1, MyHTTPSConnection)
+        req = urllib2.Request('https://api.zotero.org/users/myuserID/items')
+        # as the opener's request processing does
+        req.get_host()
+        urllib2.ProxyHandler({'https': 'proxy.example.org:3128'}).proxy_open(
+            req, 'proxy.example.org:3128', 'https')
+        self.assertEqual(None, keepalive.KeepAliveHTTPSHandler(pool).https_open(req))
+        self.assertEqual({}, pool._idle)
+
+    def testDecompressesResponses(self):
+        """ Should ask for compressed responses, and transparently decompress
+            and count them
+        """
+        compressed = StringIO()
+        gz = gzip.GzipFile(fileobj=compressed, mode='wb')
+        gz.write(self.items_doc)
+        gz.close()
+        stats = compression.TransferStats()
+        my_opener = urllib2.build_opener(
+            MyHTTPSHandler(compressed.getvalue(), 200,
+                {'Content-Encoding': 'gzip'}),
+            compression.DecompressionProcessor(stats))
+        z.urllib2.install_opener(my_opener)
+        zot = z.Zotero('myuserID', 'users', 'myuserkey')
+        items_data = zot.items()
+        self.assertEqual(u'T4AH4RZA', items_data[0]['key'])
+        self.assertEqual(
+            'gzip, deflate', zot.request.get_header('Accept-encoding'))
+        self.assertEqual(1, stats.compressed_responses)
+        self.assertEqual(len(compressed.getvalue()), stats.received)
+        self.assertEqual(len(self.items_doc), stats.decoded)
+        self.assertTrue(stats.saved > 0)
+
+    def testParseJsonFormat(self):
+        """ Should parse format=json responses without feedparser, and read
+            their links from the Link header
+        """
+        json_doc = """[{"key": "ABCD2345", "version": 12, "library": {},
+            "data": {"key": "ABCD2345", "version": 12, "itemType": "book",
+            "title": "Hello World", "tags": [{"tag": "Tag"}]}},
+            {"key": "BCDE3456", "version": 10,
+            "data": {"key": "BCDE3456", "version": 10, "itemType": "note"}}]"""
+        link_header = ('<https://api.zotero.org/users/myuserID/items?'
+            'format=json&limit=2&start=2>; rel="next", '
+            '<https://api.zotero.org/users/myuserID/items?'
+            'format=json&limit=2&start=8>; rel="last"')
+        my_opener = urllib2.build_opener(MyHTTPSHandler(json_doc, 200,
+            {'Link': link_header, 'Last-Modified-Version': '12'}))
+        z.urllib2.install_opener(my_opener)
+        zot = z.Zotero('myuserID', 'users', 'myuserkey', api_version=3)
+        items_data = zot.top(format='json', limit=2)
+        self.assertEqual(u'Hello World', items_data[0]['title'])
+        self.assertEqual(u'Tag', items_data[0]['tags'][0]['tag'])
+        self.assertEqual(u'BCDE3456', items_data[1]['key'])
+        self.assertEqual([u'ABCD2345', u'BCDE3456'], zot.item_keys)
+        self.assertEqual(
+            '/users/myuserID/items?format=json&limit=2&start=2&key=myuserkey',
+            zot.links['next'])
+        self.assertEqual(
+            '/users/myuserID/items?format=json&limit=2&start=8&key=myuserkey',
+            zot.links['last'])
+        self.assertIn('/items/top?', zot.links['self'])
+        self.assertEqual('12', zot.library_version)
+
+    def testParseJsonFormatGroups(self):
+        """ Groups retrieved as format=json should have their group_id
+        """
+        json_doc = """[{"id": 169947, "version": 2,
+            "data": {"id": 169947, "name": "Group", "version": 2}}]"""
+        my_opener = urllib2.build_opener(MyHTTPSHandler(json_doc))
+        z.urllib2.install_opener(my_opener)
+        zot = z.Zotero('myuserID', 'users', 'myuserkey', api_version=3)
+        groups_data = zot.groups(format='json')
+        self.assertEqual(169947, groups_data[0]['group_id'])
+        self.assertEqual(u'Group', groups_data[0]['name'])
+        self.assertEqual(None, zot.links.get('next'))
+
+    def testDefaultFormatFollowsApiVersion(self):
+        """ Requests without a format should ask for JSON since version 3,
+            and for Atom if they ask for a content
+        """
+        json_doc = """[{"key": "ABCD2345", "version": 12,
+            "data": {"key": "ABCD2345", "version": 12, "itemType": "book",
+            "title": "Hello World"}}]"""
+        my_opener = urllib2.build_opener(MyHTTPSHandler(json_doc))
+        z.urllib2.install_opener(my_opener)
+        zot = z.Zotero('myuserID', 'users', 'myuserkey', api_version=3)
+        items_data = zot.items()
+        self.assertIn('format=json', zot.request.get_full_url())
+        self.assertEqual(u'Hello World', items_data[0]['title'])
+        my_opener = urllib2.build_opener(MyHTTPSHandler(self.items_doc))
+        z.urllib2.install_opener(my_opener)
+        items_data = zot.items(content='json')
+        self.assertIn('format=atom', zot.request.get_full_url())
+        self.assertEqual(u'T4AH4RZA', items_data[0]['key'])
+
+    def testTimingListener(self):
+        """ Should report the duration of the request and of parsing it
+        """
+        my_opener = urllib2.build_opener(MyHTTPSHandler(self.items_doc))
+        z.urllib2.install_opener(my_opener)
+        zot = z.Zotero('myuserID', 'users', 'myuserkey')
+        timings = []
+        z.timing_listener = lambda step, seconds: timings.append(step)
+        try:
+            zot.items()
+        finally:
+            z.timing_listener = None
+        self.assertEqual(['request', 'parse'], timings)
+
+    def testAtomParserMatchesFeedparser(self):
+        """ The single-pass Atom parser should read the fields the processors
+            use just like feedparser does
+        """
+        for doc in (self.items_doc, self.bib_doc):
+            expected = feedparser.parse(doc)
+            parsed = atom.parse(StringIO(doc))
+            self.assertEqual(
+                [l['href'] for l in expected.feed['links']],
+                [l['href'] for l in parsed.feed['links']])
+            self.assertEqual(
+                expected.feed['zapi_totalresults'],
+                parsed.feed['zapi_totalresults'])
+            self.assertEqual(len(expected.entries), len(parsed.entries))
+            for exp, entry in zip(expected.entries, parsed.entries):
+                for field in ('title', 'zapi_key', 'updated_parsed'):
+                    self.assertEqual(exp[field], entry[field])
+                self.assertEqual(
+                    exp['links'][0]['href'], entry['links'][0]['href'])
+                self.assertEqual(
+                    exp['content'][0]['value'], entry['content'][0]['value'])
+        self.assertEqual(z.etags(self.items_doc),
+            atom.parse(self.items_doc).etags)
+
+    def testSchedulerRetriesTooManyRequests(self):
+        """ Should wait as long as Retry-After asks for, and retry
+        """
+        handler = MySequenceHTTPSHandler([
+            (self.items_doc, 429, {'Retry-After': '3'}),
+            (self.items_doc, 200, {'Backoff': '2'})])
+        z.urllib2.install_opener(urllib2.build_opener(handler))
+        slept = []
+        now = [1000.0]
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+        sched = scheduler.RequestScheduler(sleep=sleep, clock=lambda: now[0])
+        response = sched.open(
+            urllib2.Request('https://api.zotero.org/users/1/items'), 'key')
+        self.assertEqual(200, response.code)
+        self.assertEqual(2, handler.requests)
+        self.assertEqual([3.0], slept)
+        # the Backoff header delays the next request
+        sched.wait('key')
+        self.assertEqual([3.0, 2.0], slept)
+
+    def testSchedulerPacesRequests(self):
+        """ Requests exceeding the burst should be paced to the rate, and
+            errors which can't be retried should be raised
+        """
+        slept = []
+        now = [0.0]
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+        sched = scheduler.RequestScheduler(
+            rate=2.0, burst=2, sleep=sleep, clock=lambda: now[0])
+        for _ in range(4):
+            sched.wait('key')
+        self.assertEqual([0.5, 0.5], slept)
+        sched.wait('other key')
+        self.assertEqual(2, len(slept))
+        handler = MySequenceHTTPSHandler([(self.items_doc, 403)])
+        z.urllib2.install_opener(urllib2.build_opener(handler))
+        with self.assertRaises(urllib2.HTTPError):
+            sched.open(
+                urllib2.Request('https://api.zotero.org/users/1/items'))
+        self.assertEqual(1, handler.requests)
+
+    def testConditionalGetFromCache(self):
+        """ Should revalidate cached responses with their validators, and
+            answer 304 responses from the cache
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            cache = httpcache.ResponseCache(directory)
+            handler = MySequenceHTTPSHandler([
+                (self.items_doc, 200, {'ETag': '"abc"',
+                    'Last-Modified-Version': '7'}),
+                ('', 304, {})])
+            z.urllib2.install_opener(urllib2.build_opener(
+                handler, httpcache.ConditionalGetProcessor(cache)))
+            zot = z.Zotero('myuserID', 'users', 'myuserkey')
+            first = zot.items()
+            self.assertFalse(handler.sent[0].has_header('If-none-match'))
+            # a fresh cache reads the responses stored before
+            cache = httpcache.ResponseCache(directory)
+            z.urllib2.install_opener(urllib2.build_opener(
+                handler, httpcache.ConditionalGetProcessor(cache)))
+            second = zot.items()
+            self.assertEqual('"abc"', handler.sent[1].get_header('If-none-match'))
+            self.assertEqual(
+                '7', handler.sent[1].get_header('If-modified-since-version'))
+            self.assertEqual(first, second)
+            self.assertEqual('7', zot.library_version)
+        finally:
+            shutil.rmtree(directory)
+
+    def testConditionalGetCachesWhileReading(self):
+        """ Should cache a body once it was read completely, but neither
+            one closed before nor the following pages of a listing
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            cache = httpcache.ResponseCache(directory)
+            validators = {'Last-Modified-Version': '7'}
+            handler = MySequenceHTTPSHandler([
+                (self.items_doc, 200, validators),
+                (self.items_doc, 200, validators),
+                (self.items_doc, 200, validators)])
+            opener = urllib2.build_opener(
+                handler, httpcache.ConditionalGetProcessor(cache))
+            url = 'https://api.zotero.org/users/1/items?limit=2'
+            response = opener.open(url)
+            self.assertEqual(200, response.code)
+            self.assertFalse(response.from_cache)
+            self.assertEqual(self.items_doc[:10], response.read(10))
+            self.assertEqual(None, cache.get(url))
+            self.assertEqual(self.items_doc[10:], response.read())
+            self.assertEqual(self.items_doc, cache.get(url)[1])
+            # a body closed before it was read isn't cached
+            response = opener.open(url + '&format=json')
+            response.read(10)
+            response.close()
+            self.assertEqual(None, cache.get(url + '&format=json'))
+            # neither are the following pages of a listing
+            response = opener.open(url + '&start=2')
+            self.assertEqual(self.items_doc, response.read())
+            self.assertEqual(None, cache.get(url + '&start=2'))
+            self.assertEqual(['.response'], [os.path.splitext(name)[1]
+                for name in os.listdir(directory)])
+        finally:
+            shutil.rmtree(directory)
+
+    def testResponseCacheEvictsLeastRecentlyUsed(self):
+        """ Should remove the least recently used responses once the cache
+            exceeds its size
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            cache = httpcache.ResponseCache(directory)
+            cache.put('a', '', 'x' * 1000)
+            cache.put('b', '', 'x' * 1000)
+            cache.max_bytes = cache._total + 500
+            cache.touch('a')
+            cache.put('c', '', 'x' * 1000)
+            self.assertEqual(('', 'x' * 1000), cache.get('a'))
+            self.assertEqual(None, cache.get('b'))
+            self.assertEqual(('', 'x' * 1000), cache.get('c'))
+            self.assertEqual(2, len(httpcache.ResponseCache(directory)._sizes))
+        finally:
+            shutil.rmtree(directory)
+
+    def testResponseCacheLeavesOutApiKey(self):
+        """ Should neither store the API key nor use it to look responses up
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            cache = httpcache.ResponseCache(directory)
+            cache.put('https://api.zotero.org/users/1/items?key=secret&limit=5',
+                '', 'body')
+            self.assertEqual(('', 'body'), cache.get(
+                'https://api.zotero.org/users/1/items?key=other&limit=5'))
+            self.assertEqual(None, cache.get(
+                'https://api.zotero.org/users/1/items?limit=50'))
+            for name in os.listdir(directory):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    self.assertFalse('secret' in f.read())
+        finally:
+            shutil.rmtree(directory)
+
+    def testResponseCacheForgetsDamagedFiles(self):
+        """ Should treat files which can't be unpickled as missing, and
+            remove them
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            cache = httpcache.ResponseCache(directory)
+            for damaged in ('Iabc\n.', 'cno_such_module\nname\n.', 'N.'):
+                cache.put('a', '', 'x')
+                path = os.path.join(directory, cache._name('a'))
+                with open(path, 'wb') as f:
+                    f.write(damaged)
+                self.assertEqual(None, cache.get('a'))
+                self.assertFalse(os.path.exists(path))
+                self.assertEqual(0, cache._total)
+        finally:
+            shutil.rmtree(directory)
+
+    def testImportDefersHeavyDependencies(self):
+        """ Importing zotero shouldn't import feedparser or pytz, and should
+            stay within its time budget
+        """
+        script = ('import sys, time; start = time.time(); import zotero; '
+            'print time.time() - start; '
+            'print sorted([m for m in ("feedparser", "pytz") '
+            'if sys.modules.get(m) is not None])')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.Popen([sys.executable, '-c', script],
+            stdout=subprocess.PIPE, env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+        seconds, modules = output.splitlines()[-2:]
+        self.assertEqual('[]', modules)
+        # generous, so slow machines pass; heavy imports are caught above
+        self.assertTrue(float(seconds) < 0.5,
+            'importing zotero took %s seconds' % seconds)
+
     def testTooManyItems(self):
         """ Should fail because we're passing too many items
         """
@@ -30,7 +30,6 @@ __version__ = '0.9.9.1'
 import urllib
 import urllib2
 import socket
-import feedparser
 import json
 import uuid
 import time
@@ -38,9 +37,6 @@ import os
 import hashlib
 import datetime
 import re
-import pytz
-from poster.encode import multipart_encode
-from poster.streaminghttp import register_openers as reg_open
 import mimetypes
 from urlparse import urlparse
 import xml.etree.ElementTree as et
@@ -51,13 +47,28 @@ except ImportError:
     from ordereddict import OrderedDict
 
 import zotero_errors as ze
+import keepalive
+import atom
+import scheduler
+import compression
 
 
 # Avoid hanging the application if there's no server response
 timeout = 30
 socket.setdefaulttimeout(timeout)
-# register streaming HTTP opener for file uploads
-reg_open()
+# register pooled keep-alive HTTPS and streaming HTTP openers for file uploads
+keepalive.register_openers()
+
+# If set, called with a step name and its duration in seconds for every read
+# request: 'request' until the response arrived, 'parse' for processing it
+timing_listener = None
+
+
+def timed(step, start):
+    """ Report the time since start to the timing listener, if there is one
+    """
+    if timing_listener is not None:
+        timing_listener(step, time.time() - start)
 
 
 def ib64_patched(self, attrsD, contentparams):
@@ -95,8 +106,14 @@ def etags(incoming):
         pass
 
 
-# Override feedparser's buggy isBase64 method until they fix it
-feedparser._FeedParserMixin._isBase64 = ib64_patched
+def load_feedparser():
+    """ Import feedparser, which is slow to import and only needed for the
+        responses of write requests, on first use
+    """
+    import feedparser
+    # Override feedparser's buggy isBase64 method until they fix it
+    feedparser._FeedParserMixin._isBase64 = ib64_patched
+    return feedparser
 
 
 def cleanwrap(func):
@@ -120,32 +137,47 @@ def retrieve(func):
         func's return value is part of a URI, and it's this
         which is intercepted and passed to _retrieve_data:
         '/users/123/items?key=abc123'
-        the atom doc returned by _retrieve_data is then
-        passed to _etags in order to extract the etag attributes
-        from each entry, then to feedparser, then to the correct processor
+        the atom doc returned by _open_data is then
+        parsed by atom.parse in a single pass, which also extracts the
+        etag attributes, then passed to the correct processor
         """
         if kwargs:
             self.add_parameters(**kwargs)
-        retrieved = self._retrieve_data(func(self, *args))
+        query = func(self, *args)
         # determine content and format, based on url params
-        content = self.content.search(
-            self.request.get_full_url()) and \
-            self.content.search(
-                self.request.get_full_url()).group(0) or 'bib'
-        fmt = self.fmt.search(
-            self.request.get_full_url()) and \
-            self.fmt.search(
-                self.request.get_full_url()).group(0) or 'atom'
-        # step 1: process atom if it's atom-formatted
+        full_url = '%s%s' % (self.endpoint, query)
+        content = self.content.search(full_url) and \
+            self.content.search(full_url).group(0) or 'bib'
+        fmt = self.fmt.search(full_url) and \
+            self.fmt.search(full_url).group(0) or self._default_format()
+        # process atom if it's atom-formatted, reading it as it arrives
         if fmt == 'atom':
-            parsed = feedparser.parse(retrieved)
+            response = self._open_data(query)
+            start = time.time()
+            try:
+                parsed = atom.parse(response)
+            finally:
+                response.close()
             processor = self.processors.get(content)
-            # step 2: if the content is JSON, extract its etags
+            # if the content is JSON, keep its etags
             if processor == self._json_processor:
-                self.etags = etags(retrieved)
+                self.etags = parsed.etags
             # extract next, previous, first, last links
             self.links = self._extract_links(parsed)
-            return processor(parsed)
+            # remember which item each entry belongs to
+            self.item_keys = [e.get('zapi_key') for e in parsed.entries]
+            processed = processor(parsed)
+            timed('parse', start)
+            return processed
+        retrieved = self._retrieve_data(query)
+        # JSON needs neither feedparser nor etags, and has its links in the
+        # Link header
+        if fmt == 'json':
+            start = time.time()
+            self.links = self._extract_link_header()
+            processed = self._json_format_processor(retrieved)
+            timed('parse', start)
+            return processed
         # otherwise, just return the unparsed content as is
         else:
             return retrieved
@@ -159,7 +191,7 @@ class Zotero(object):
     http://www.zotero.org/support/dev/server_api
     """
     def __init__(self, library_id=None, library_type=None, api_key=None,
-                 preserve_json_order=False):
+                 preserve_json_order=False, api_version=None):
         """ Store Zotero credentials
         """
         self.endpoint = 'https://api.zotero.org'
@@ -174,6 +206,10 @@ class Zotero(object):
         if api_key:
             self.api_key = api_key
         self.preserve_json_order = preserve_json_order
+        # sent as Zotero-API-Version header if set, e.g. 2 for library versions
+        self.api_version = api_version
+        self.library_version = None
+        self.link_header = None
         self.url_params = None
         self.etags = None
         self.request = None
@@ -200,6 +236,7 @@ class Zotero(object):
             'json': self._json_processor
             }
         self.links = None
+        self.item_keys = None
         self.templates = {}
 
     def _cache(self, template, key):
@@ -208,6 +245,8 @@ class Zotero(object):
         accepts a dict and key name, adds the retrieval time, and adds both
         to self.templates as a new dict using the specified key
         """
+        # imported here, as it's slow to import
+        import pytz
         # cache template and retrieval time for subsequent calls
         thetime = datetime.datetime.utcnow().replace(
             tzinfo=pytz.timezone('GMT'))
@@ -229,16 +268,34 @@ class Zotero(object):
         Combine endpoint and request to access the specific resource
         Returns an Atom document
         """
+        response = self._open_data(request)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def _open_data(self, request=None):
+        """
+        Request the specific resource, and return the response to be read
+        """
         full_url = '%s%s' % (self.endpoint, request)
         self.request = urllib2.Request(full_url)
         self.request.add_header('User-Agent', 'Pyzotero/%s' % __version__)
+        if self.api_version:
+            self.request.add_header('Zotero-API-Version', self.api_version)
+        start = time.time()
         try:
-            response = urllib2.urlopen(self.request)
-            data = response.read()
+            # paced, and retried if the API asks for it
+            response = scheduler.default.open(
+                self.request, getattr(self, 'api_key', None))
         except (urllib2.HTTPError, urllib2.URLError), error:
             error_handler(self.request, error)
-        # parse the result into Python data structures
-        return data
+        timed('request', start)
+        # remember the library version the response corresponds to
+        self.library_version = header_value(response, 'Last-Modified-Version')
+        # pagination of format=json responses
+        self.link_header = header_value(response, 'Link')
+        return response
 
     def _extract_links(self, doc):
         """
@@ -272,11 +329,13 @@ class Zotero(object):
         As per the API docs, a template less than 1 hour old is
         assumed to be fresh, and will immediately return False if found
         """
+        import pytz
         # If the template is more than an hour old, try a 304
         if abs(datetime.datetime.utcnow().replace(
             tzinfo=pytz.timezone('GMT')) -
             self.templates[template]['updated']).seconds > 3600:
-            opener = urllib2.build_opener(NotModifiedHandler())
+            opener = urllib2.build_opener(
+                NotModifiedHandler(), compression.DecompressionProcessor())
             query = self.endpoint + url.format(
                 u=self.library_id, t=self.library_type, **payload)
             req = urllib2.Request(query)
@@ -302,9 +361,42 @@ class Zotero(object):
             params = {'key': self.api_key}
         # always return json, unless different format is specified
         if 'content' not in params and 'format' not in params:
-            params['content'] = 'json'
+            if self._default_format() == 'json':
+                params['format'] = 'json'
+            else:
+                params['content'] = 'json'
+        # content is only honoured for the Atom format since version 3
+        elif 'format' not in params and self._default_format() == 'json':
+            params['format'] = 'atom'
         self.url_params = urllib.urlencode(params)
 
+    def _default_format(self):
+        """ The format the API responds in if none is requested: JSON since
+            version 3, Atom before
+        """
+        if self.api_version and int(self.api_version) >= 3:
+            return 'json'
+        return 'atom'
+
+    def _extract_link_header(self):
+        """
+        Extract self, first, prev, next, last links from the Link header of
+        the last response, and add an instance's API key to them if it exists
+        """
+        full_url = self.request.get_full_url()
+        extracted = {'self': full_url[len(self.endpoint):]}
+        for link in (self.link_header or '').split(','):
+            match = re.match(r'\s*<([^>]*)>\s*;\s*rel="?(\w+)"?', link)
+            if not match:
+                continue
+            url = urlparse(match.group(1))
+            if hasattr(self, 'api_key') and 'key=' not in url[4]:
+                extracted[match.group(2)] = '{0}?{1}&key={2}'.format(
+                    url[2], url[4], self.api_key)
+            else:
+                extracted[match.group(2)] = '{0}?{1}'.format(url[2], url[4])
+        return extracted
+
     def _build_query(self, query_string):
         """
         Set request parameters. Will always add the user ID if it hasn't
@@ -350,7 +442,7 @@ class Zotero(object):
         self.add_parameters(limit=1)
         data = self._retrieve_data(query)
         self.url_params = None
-        parsed = feedparser.parse(data)
+        parsed = atom.parse(data)
         # extract the 'total items' figure
         return int(parsed.feed['zapi_totalresults'].encode('utf8'))
 
@@ -444,6 +536,22 @@ class Zotero(object):
         u=self.library_id, t=self.library_type, i=item.upper())
         return self._build_query(query_string)
 
+    def deleted(self, **kwargs):
+        """
+        Get the keys of items, collections, searches and tags which have been
+        deleted since the library version passed as 'newer', or as 'since'
+        with api_version 3
+        Requires api_version 2 or later; returns a dict of lists
+        """
+        params = dict(kwargs)
+        if hasattr(self, 'api_key'):
+            params['key'] = self.api_key
+        # the deleted endpoint only returns JSON, so don't add 'content'
+        self.url_params = urllib.urlencode(params)
+        query = self._build_query('/{t}/{u}/deleted')
+        self.url_params = None
+        return json.loads(self._retrieve_data(query))
+
     def all_top(self, **kwargs):
         """ Retrieve all top-level items
         """
@@ -484,23 +592,24 @@ class Zotero(object):
             items.extend(self.follow())
         return items
 
-    def get_subset(self, subset):
+    def get_subset(self, subset, **kwargs):
         """
-        Retrieve a subset of items
-        Accepts a single argument: a list of item IDs
+        Retrieve a subset of items using a single request
+        Accepts a list of up to 50 item IDs, and optional search / request
+        parameters. The keys of the returned items are in self.item_keys
         """
         if len(subset) > 50:
             raise ze.TooManyItems, \
                     "You may only retrieve 50 items per call"
-        # remember any url parameters that have been set
-        params = self.url_params
-        retr = []
-        for itm in subset:
-            retr.extend(self.item(itm))
-            self.url_params = params
-        # clean up URL params when we're finished
-        self.url_params = None
-        return retr
+        item_keys = ','.join([itm.upper() for itm in subset])
+        if not kwargs and self.url_params:
+            # keep any url parameters that have been set
+            self.url_params = '%s&%s' % (
+                self.url_params, urllib.urlencode({'itemKey': item_keys}))
+        else:
+            kwargs['itemKey'] = item_keys
+            self.add_parameters(**kwargs)
+        return self.items()
 
     # The following methods process data returned by Read API calls
     def _json_processor(self, retrieved):
@@ -541,11 +650,38 @@ class Zotero(object):
                 for g in retrieved.entries]
             for k, val in enumerate(items):
                 val[u'group_id'] = group_id[k]
-        except KeyError:
+        except (KeyError, IndexError):
             pass
         self.url_params = None
         return items
 
+    def _json_format_processor(self, retrieved):
+        """
+        Return the data dicts of a format=json response, which are parsed in
+        a single pass. Like the Atom processors, items get their 'key' and
+        groups their 'group_id'
+        """
+        json_kwargs = {}
+        if self.preserve_json_order:
+            json_kwargs['object_pairs_hook'] = OrderedDict
+        retrieved = json.loads(retrieved, **json_kwargs)
+        if isinstance(retrieved, dict):
+            # a single object
+            retrieved = [retrieved]
+        items = []
+        self.item_keys = []
+        for obj in retrieved:
+            item = obj.get(u'data', obj)
+            if u'key' in obj:
+                item[u'key'] = obj[u'key']
+            elif u'id' in obj:
+                item[u'group_id'] = obj[u'id']
+            items.append(item)
+            self.item_keys.append(obj.get(u'key'))
+        self.etags = None
+        self.url_params = None
+        return items
+
     def _csljson_processor(self, retrieved):
         """ Return a list of dicts which are dumped CSL JSON
         """
@@ -629,7 +765,7 @@ class Zotero(object):
             data = resp.read()
         except (urllib2.HTTPError, urllib2.URLError), error:
             error_handler(req, error)
-        created = self._json_processor(feedparser.parse(data))
+        created = self._json_processor(load_feedparser().parse(data))
         for idx, content in enumerate(payload):
             attach = content.get('filename')
             if attach:
@@ -671,6 +807,7 @@ class Zotero(object):
                 # we're working directly with the form parameters here
                     formdata = list(authdata.items())
                     formdata.append(('file', open(attach, 'r')))
+                    from poster.encode import multipart_encode
                     encoded, headers = multipart_encode(formdata)
                     upload = urllib2.Request(authdata['url'], encoded, headers)
                     try:
@@ -857,7 +994,7 @@ class Zotero(object):
             self.etags = etags(data)
         except (urllib2.HTTPError, urllib2.URLError), error:
             error_handler(req, error)
-        return self._json_processor(feedparser.parse(data))
+        return self._json_processor(load_feedparser().parse(data))
 
     def create_collection(self, payload):
         """
@@ -973,7 +1110,7 @@ class Zotero(object):
             self.etags = etags(data)
         except (urllib2.HTTPError, urllib2.URLError), error:
             error_handler(req, error)
-        return self._json_processor(feedparser.parse(data))
+        return self._json_processor(load_feedparser().parse(data))
 
     def addto_collection(self, collection, payload):
         """
@@ -1065,6 +1202,16 @@ class Zotero(object):
         return True
 
 
+def header_value(response, header):
+    """ Return the value of a response header, or None if it isn't present
+    """
+    try:
+        return response.info().getheader(header)
+    except AttributeError:
+        # responses without parsed headers
+        return None
+
+
 def error_handler(req, error):
     """ Error handler for HTTP requests
     """
@@ -7,6 +7,15 @@ import sys
 import re
 import codecs
 import threading
+import Queue
+import heapq
+import cPickle
+import zlib
+import time
+import json
+import bisect
+import functools
+import contextlib
 
 if os.name == 'nt':
     from ctypes import windll, create_unicode_buffer
@@ -31,29 +40,218 @@ add_to_path(os.path.join(lib_folder, 'pytz-2013b'))
 add_to_path(os.path.join(lib_folder, 'poster-0.8.1'))
 add_to_path(os.path.join(lib_folder, 'ordereddict-1.1'))
 
+cache_folder = os.path.join(sublime.packages_path(), 'User', 'ZoteroCite.cache')
 
-from pyzotero import zotero
+
+def replace_file(source, destination):
+    if os.name == 'nt' and os.path.exists(destination):
+        # Windows can't rename onto an existing file
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+def importZotero():
+    """Returns the pyzotero module. pyzotero and its dependencies are slow to import, so they are
+    only imported once the first library is created, rather than when the plugin is loaded"""
+    from pyzotero import zotero
+    if zotero.timing_listener is None:
+        # The network and parse times of each request to Zotero
+        zotero.timing_listener = lambda step, seconds: performanceStats.record("zotero." + step, seconds)
+    return zotero
+
+
+class PerformanceStats(object):
+    """Counters and latency histograms of the plugin's operations, so slow updates can be traced to
+    the network, parsing or merging. Latencies are counted in buckets by their upper bound in
+    milliseconds, the last bucket is unbounded"""
+    __bucketBounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # If set, the stats are written to this JSON-file after every update
+        self.logPath = None
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__timings = {}
+            self.__counters = {}
+            self.__since = time.time()
+
+    def record(self, name, seconds):
+        bucket = bisect.bisect_left(self.__bucketBounds, seconds * 1000)
+        with self.__lock:
+            timing = self.__timings.get(name)
+            if timing is None:
+                timing = {"count": 0, "seconds": 0.0, "maxSeconds": 0.0,
+                          "buckets": [0] * (len(self.__bucketBounds) + 1)}
+                self.__timings[name] = timing
+            timing["count"] += 1
+            timing["seconds"] += seconds
+            timing["maxSeconds"] = max(timing["maxSeconds"], seconds)
+            timing["buckets"][bucket] += 1
+
+    def count(self, name, amount=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def snapshot(self):
+        """A copy of all stats as a dict, which can be dumped as JSON"""
+        with self.__lock:
+            timings = dict([(name, dict(timing, buckets=list(timing["buckets"])))
+                            for name, timing in self.__timings.items()])
+            counters = dict(self.__counters)
+            since = self.__since
+        compression = sys.modules.get("pyzotero.compression")
+        # Nothing was transferred unless pyzotero was imported
+        if compression is not None:
+            counters["transfer.receivedBytes"] = compression.stats.received
+            counters["transfer.decodedBytes"] = compression.stats.decoded
+            counters["transfer.uncompressedResponses"] = compression.stats.uncompressed_responses
+        return {"since": since, "bucketBoundsMs": list(self.__bucketBounds), "timings": timings, "counters": counters}
+
+    def report(self):
+        """The stats as text, with the percentiles estimated from the histograms"""
+        snapshot = self.snapshot()
+        lines = ["ZoteroCite performance stats since %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["since"])),
+                 "",
+                 "%-22s %7s %10s %9s %9s %9s %9s" % ("operation", "count", "total s", "mean ms", "p50 ms", "p90 ms", "max ms")]
+        for name, timing in sorted(snapshot["timings"].items()):
+            lines.append("%-22s %7d %10.3f %9.1f %9s %9s %9.1f" % (
+                name, timing["count"], timing["seconds"], timing["seconds"] * 1000 / timing["count"],
+                self.__percentile(timing, 0.5), self.__percentile(timing, 0.9), timing["maxSeconds"] * 1000))
+        lines.extend(["", "latency histograms (calls per bucket, by upper bound in ms)"])
+        for name, timing in sorted(snapshot["timings"].items()):
+            lines.append("%-22s %s" % (name, "  ".join(["%s:%d" % (self.__bucketLabel(bucket), count)
+                                                          for bucket, count in enumerate(timing["buckets"]) if count > 0])))
+        lines.extend(["", "counters"])
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("%-34s %12d" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def log(self):
+        """Writes the stats to the log, if there is one"""
+        logPath = self.logPath
+        if logPath is None:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(logPath)):
+                os.makedirs(os.path.dirname(logPath))
+            with open(logPath + ".tmp", "w") as f:
+                json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+            replace_file(logPath + ".tmp", logPath)
+        except (IOError, OSError), e:
+            print "Warning: Couldn't write performance log: %s" % e
+
+    @classmethod
+    def __bucketLabel(cls, bucket):
+        if bucket < len(cls.__bucketBounds):
+            return "<%d" % cls.__bucketBounds[bucket]
+        return ">%d" % cls.__bucketBounds[-1]
+
+    @classmethod
+    def __percentile(cls, timing, fraction):
+        """The upper bound of the bucket the given fraction of the calls falls into"""
+        seen = 0
+        for bucket, count in enumerate(timing["buckets"]):
+            seen += count
+            if seen >= fraction * timing["count"]:
+                return cls.__bucketLabel(bucket)
+
+performanceStats = PerformanceStats()
+
+
+def timed(name):
+    """Decorator recording the duration of every call of a function in performanceStats"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with performanceStats.timed(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class Library(object):
     __instances = {}
+    __responseCache = None
 
-    def __init__(self, view, zotLibId, zotLibKey, pathToBibFile=None, noUpdate=False):
-        """Initializes a library based on a Zoteros user library and an optional BibTex-file"""
+    def __init__(self, view, zotLibId, zotLibKey, pathToBibFile=None, noUpdate=False, maxParallelRequests=4,
+                 bibTexPrefetchCount=25):
+        """Initializes a library based on a Zoteros user library and an optional BibTex-file.
+        The Zotero items are shared with all other libraries of the same Zotero account, so
+        a library only holds the items cited in its BibTex-file. Items cached by previous
+        sessions are available immediately, in which case the update from Zotero is done in
+        the background"""
         self.__instances[view.buffer_id()] = self
         self.__pathToBibFile = pathToBibFile
-        self.__zoteroInstances = {}
-        self.__libItems = []
-        self.__rootZoteroCredentials = (zotLibId, zotLibKey)
+        # What was last read from or written to the BibTex-file, to skip saving if nothing changed
+        self.__savedBibTexStrings = None
+        self.__bibFileStat = None
+        # What the BibTex-file holds besides entries, like @string-entries and comments. It's
+        # written back ahead of the entries, so macros are defined before they are used
+        self.__rawBlocks = []
+        self.__citedChanged = False
+        self.__citedItems = []
+        self.__panelModel = None
+        self.__panelRows = None
+        self.__searchIndex = SearchIndex()
+        # Positions of the items in __citedItems by Zotero key and by BibTex citekey
+        self.__idIndex = {}
+        self.__citeKeyIndex = {}
         self.__libLock = threading.RLock()
-        self.__zoteroLock = threading.RLock()
+        self.__store = ZoteroItemStore.acquire(self, zotLibId, zotLibKey, maxParallelRequests, bibTexPrefetchCount)
         if not noUpdate:
-            self.update()
+            if self.__store.synced:
+                self.__mergeBibFileItems()
+            elif self.__store.itemCount > 0:
+                self.__mergeBibFileItems()
+                threading.Thread(target=self.update).start()
+            else:
+                self.update()
 
     @property
     def LibraryItems(self):
+        return list(self.panelModel)
+
+    @property
+    def panelModel(self):
+        """The library items sorted for the quick panel. It's kept until the library changes, so it
+        must not be modified. Their menu rows are only built while the panel is shown"""
+        return self.__warmPanelModel()
+
+    def __warmPanelModel(self):
+        """Sorts the items for the quick panel, unless they are sorted already, and returns them"""
         with self.__libLock:
-            return list(self.__libItems)
+            if self.__panelModel is None:
+                with performanceStats.timed("library.panelModel"):
+                    # Cited items replace their Zotero counterparts. The Zotero items are sorted
+                    # already, so sorting only has to merge the cited ones in
+                    sortedItems = [item for item in self.__store.sortedItems if item.id not in self.__idIndex]
+                    sortedItems.extend(self.__citedItems)
+                    sortedItems.sort(key=lambda item: item.sortKey)
+                    self.__panelModel = sortedItems
+                    self.__panelRows = None
+            return self.__panelModel
+
+    @property
+    def panel(self):
+        """The panelModel along with the menu rows of its items. The rows are built when the panel
+        is first shown and kept along with the panelModel, so showing it again doesn't decode them"""
+        with self.__libLock:
+            panelModel = self.panelModel
+            if self.__panelRows is None:
+                with performanceStats.timed("library.panelRows"):
+                    self.__panelRows = [item.menuRows for item in panelModel]
+            return panelModel, self.__panelRows
 
     @property
     def pathToBibFile(self):
@@ -63,18 +261,53 @@ class Library(object):
     def pathToBibFile(self, value):
         with self.__libLock:
             self.__pathToBibFile = value
+            self.__bibFileStat = None
 
     def update(self):
         """Collect all items from Zotero and if it exists unions them with those from
-        the BibTex-file. In case of matches it assumes Zoteros' version to be the correct one"""
-        newItems = []
-        if self.pathToBibFile is not None:
+        the BibTex-file. In case of matches it assumes Zoteros' version to be the correct one.
+        Zotero libraries which have been synced before are only queried for changes"""
+        with performanceStats.timed("library.update"):
+            self.__mergeBibFileItems()
+            self.__store.update()
+            # Sort now, so opening the quick panel doesn't have to
+            self.__warmPanelModel()
+        performanceStats.log()
+
+    def zoteroItemsChanged(self, newItems):
+        """Called by the ZoteroItemStore whenever its items changed. Cited items are replaced by
+        their new version"""
+        with self.__libLock:
+            self.__panelModel = None
+            citedReplacements = [item for item in newItems if self.__indexOf(item) is not None]
+        if len(citedReplacements) == 0:
+            return
+        # Replacements of cited items need a BibTexEntry, which are retrieved in batches
+        bibTexEntries = self.__store.bibTexEntriesForLibItems(citedReplacements)
+        citedItems = []
+        for item in citedReplacements:
+            bibTexEntry = bibTexEntries.get((item.zotInstance, item.id))
+            if bibTexEntry is None:
+                bibTexEntry = self.__store.bibTexEntryForLibItem(item)
+            if bibTexEntry is not None:
+                citedItems.append(item.withBibTexEntry(bibTexEntry))
+        self.__mergeCitedItems(citedItems)
+
+    @timed("bibFile.merge")
+    def __mergeBibFileItems(self):
+        pathToBibFile = self.pathToBibFile
+        if pathToBibFile is not None:
+            bibFileStat = self.__statBibFile(pathToBibFile)
+            rawBlocks = []
+            bibTexEntries = list(self.__readFromBibFile(pathToBibFile, rawBlocks))
             with self.__libLock:
-                bibTexEntries = self.__readFromBibFile(self.pathToBibFile)
-            newItems.extend(
+                citedChanged = self.__citedChanged
+                if pathToBibFile == self.pathToBibFile:
+                    self.__rawBlocks = rawBlocks
+            self.__mergeCitedItems(
                 [LibraryItem(
                     entry.zoteroKey,
-                    None,
+                    self.__zoteroIdentifierForBibTexEntry(entry),
                     entry.author,
                     entry.title,
                     entry.year,
@@ -82,55 +315,149 @@ class Library(object):
                     entry
                 ) for entry in bibTexEntries]
             )
-        newItems.extend(self.__getAllUserItems(*self.__rootZoteroCredentials))
+            with self.__libLock:
+                if not citedChanged and pathToBibFile == self.pathToBibFile:
+                    # The file already contains what was just read from it
+                    self.__savedBibTexStrings = rawBlocks + [entry.bibTexString for entry in bibTexEntries]
+                    self.__bibFileStat = bibFileStat
+                    self.__citedChanged = False
+
+    @staticmethod
+    def __zoteroIdentifierForBibTexEntry(bibTexEntry):
+        if bibTexEntry.zoteroLibraryId is None or bibTexEntry.zoteroLibraryType is None:
+            return None
+        return (bibTexEntry.zoteroLibraryId, bibTexEntry.zoteroLibraryType)
+
+    def __mergeCitedItems(self, newItems):
+        """Merges cited items into the library, replacing the already cited equal ones"""
         with self.__libLock:
+            if len(newItems) > 0:
+                self.__panelModel = None
+                self.__citedChanged = True
             for item in newItems:
-                if item in self.__libItems:
-                    index = self.__libItems.index(item)
-                    if self.__libItems[index].cited:
-                        if item.bibTexEntry is None:
-                            item.bibTexEntry = self.__bibTexEntryForLibItem(item)
-                        #The cited one has a bibTexEntry
-                        if self.__libItems[index].bibTexEntry.key != item.bibTexEntry.key:
-                            print "Warning: Citekey %s changed to %s" % (self.__libItems[index].bibTexEntry.key, item.bibTexEntry.key)
-                            raise NotImplementedError
-                            # Do sth. like replace the old keys
-                    self.__libItems[index] = item
+                index = self.__indexOf(item)
+                if index is not None:
+                    if self.__citedItems[index].bibTexEntry.key != item.bibTexEntry.key:
+                        print "Warning: Citekey %s changed to %s" % (self.__citedItems[index].bibTexEntry.key, item.bibTexEntry.key)
+                        raise NotImplementedError
+                        # Do sth. like replace the old keys
+                    self.__unindexItem(index)
+                    self.__searchIndex.remove(self.__citedItems[index])
+                    self.__citedItems[index] = item
                 else:
-                    self.__libItems.append(item)
+                    index = len(self.__citedItems)
+                    self.__citedItems.append(item)
+                self.__indexItem(index)
+                self.__searchIndex.add(item)
+
+    def __indexOf(self, item):
+        """Returns the position of the cited item equal to the given one, see LibraryItem.__eq__"""
+        if item.id is not None:
+            index = self.__idIndex.get(item.id)
+            if index is not None:
+                return index
+        if item.bibTexEntry is not None:
+            index = self.__citeKeyIndex.get(item.bibTexEntry.key)
+            if index is not None and (item.id is None or self.__citedItems[index].id is None):
+                return index
+        return None
+
+    def __indexItem(self, index):
+        item = self.__citedItems[index]
+        if item.id is not None:
+            self.__idIndex[item.id] = index
+        self.__citeKeyIndex[item.bibTexEntry.key] = index
 
+    def __unindexItem(self, index):
+        item = self.__citedItems[index]
+        if item.id is not None and self.__idIndex.get(item.id) == index:
+            del self.__idIndex[item.id]
+        if self.__citeKeyIndex.get(item.bibTexEntry.key) == index:
+            del self.__citeKeyIndex[item.bibTexEntry.key]
+
+    @timed("library.save")
     def save(self):
+        """Writes the cited entries to the BibTex-file. The file is only written if the cited
+        entries changed since it was last read or written, or if it was changed by someone else"""
         with self.__libLock:
             if self.pathToBibFile is not None:
-                self.__writeToBibFile([item.bibTexEntry for item in self.LibraryItems if item.cited], self.pathToBibFile)
+                if self.__citedChanged or self.__bibFileStat != self.__statBibFile(self.pathToBibFile):
+                    bibTexStrings = self.__rawBlocks + [item.bibTexEntry.bibTexString for item in self.__citedItems]
+                    if bibTexStrings != self.__savedBibTexStrings or self.__bibFileStat != self.__statBibFile(self.pathToBibFile):
+                        self.__writeToBibFile(bibTexStrings, self.pathToBibFile)
+                        self.__savedBibTexStrings = bibTexStrings
+                        self.__bibFileStat = self.__statBibFile(self.pathToBibFile)
+                    self.__citedChanged = False
                 return True
             else:
                 return False
 
+    @timed("library.cite")
     def cite(self, libItem):
-        if libItem.bibTexEntry is None:
-            libItem.bibTexEntry = self.__bibTexEntryForLibItem(libItem)
-        return libItem.bibTexEntry.key
+        """Adds the item to the cited ones and returns its citekey. The items of the shared
+        Zotero library are left alone, a cited copy of them is added instead"""
+        with self.__libLock:
+            index = self.__indexOf(libItem)
+            if index is not None:
+                return self.__citedItems[index].bibTexEntry.key
+        bibTexEntry = libItem.bibTexEntry
+        if bibTexEntry is None:
+            bibTexEntry = self.__store.bibTexEntryForLibItem(libItem)
+        self.__mergeCitedItems([libItem.withBibTexEntry(bibTexEntry)])
+        return bibTexEntry.key
+
+    @timed("library.search")
+    def search(self, query, limit=50):
+        """Returns the items best matching the query in any of their authors, title, year, tags,
+        citekey or abstract, best match first"""
+        with self.__libLock:
+            # Cited items replace their Zotero counterparts
+            ranked = [result for result in self.__store.rank(query, limit + len(self.__citedItems))
+                      if result[-1].id not in self.__idIndex]
+            ranked.extend(self.__searchIndex.rank(query, limit))
+        ranked.sort()
+        return [result[-1] for result in ranked[:limit]]
+
+    def canCiteOffline(self, libItem):
+        """Returns whether cite() can return the citekey of libItem without a request to Zotero"""
+        with self.__libLock:
+            if libItem.bibTexEntry is not None or self.__indexOf(libItem) is not None:
+                return True
+        return self.__store.hasPrefetchedBibTex(libItem)
 
     @classmethod
     def getLibraryForView(cls, view, noInitialUpdate=False):
         try:
             return cls.__instances[view.buffer_id()]
         except KeyError:
+            importZotero()
+            from pyzotero import keepalive
+            from pyzotero import httpcache
             settings = sublime.load_settings("ZoteroCite.sublime-settings")
+            cacheSize = settings.get("http_cache_size_mb", 50) * 1024 * 1024
+            if cls.__responseCache is None:
+                cls.__responseCache = httpcache.ResponseCache(os.path.join(cache_folder, 'http'), cacheSize)
+            else:
+                cls.__responseCache.max_bytes = cacheSize
+            keepalive.register_openers(settings.get("max_connections", 4), cls.__responseCache)
+            performanceStats.logPath = None
+            if settings.get("performance_log", False):
+                performanceStats.logPath = os.path.join(cache_folder, "performance.json")
             filename = None
             if view.file_name() is not None:
                 filename = os.path.splitext(view.file_name())[0] + '.bib'
-            return Library(view, settings.get("zotero_user_id"), settings.get("zotero_user_key"), filename, noInitialUpdate)
+            return Library(view, settings.get("zotero_user_id"), settings.get("zotero_user_key"), filename, noInitialUpdate,
+                           settings.get("max_parallel_requests", 4), settings.get("bibtex_prefetch_count", 25))
 
     def removeLibraryForView(self, onlyIfEmpty=True):
         if onlyIfEmpty:
-            for item in self.LibraryItems:
-                if item.cited:
+            with self.__libLock:
+                if len(self.__citedItems) > 0:
                     return
         for key in self.__instances.keys():
             if self.__instances[key] == self:
                 del self.__instances[key]
+                self.__store.release(self)
                 break
 
     @classmethod
@@ -149,99 +476,652 @@ class Library(object):
         except IOError:
             return False
 
-    def __bibTexEntryForLibItem(self, libItem):
+    @staticmethod
+    def __readFromBibFile(filePath, rawBlocks=None):
+        """Yields the BibTexEntries of the given file one at a time. Everything else in the file,
+        like @string-entries, is appended to rawBlocks if it is given"""
+        try:
+            f = codecs.open(filePath, "r", "utf-8")
+        except IOError:
+            return
+        with f:
+            for bibTexString in BibTexReader(f, rawBlocks=rawBlocks):
+                yield BibTexEntry(bibTexString)
+
+    @staticmethod
+    def __writeToBibFile(bibTexStrings, filePath):
+        """Writes the file atomically, so it's never left half written"""
+        with codecs.open(filePath + ".tmp", "w", "utf-8") as f:
+            f.writelines([bibTexString + "\n" for bibTexString in bibTexStrings])
+        replace_file(filePath + ".tmp", filePath)
+
+    @staticmethod
+    def __statBibFile(filePath):
+        try:
+            stat = os.stat(filePath)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+
+class ZoteroItemStore(object):
+    """The items of a Zotero account and all its groups. There is one store per pair of
+    Zotero credentials, which is shared by all libraries using them, so every Zotero library
+    is only held and synced once. The store is dropped once the last library released it"""
+    __stores = {}
+    __storesLock = threading.RLock()
+    __zoteroPageSize = 99
+    __zoteroApiVersion = 3
+    __zoteroBatchSize = 50
+    __cacheFormat = 2
+
+    def __init__(self, zotLibId, zotLibKey, maxParallelRequests=4, bibTexPrefetchCount=25):
+        self.__credentials = (zotLibId, zotLibKey)
+        self.__libraries = []
+        self.__zoteroInstances = {}
+        self.__zoteroLocks = {}
+        self.__libraryVersions = {}
+        self.__subLibraries = {}
+        self.__cachedStates = {}
+        self.__items = []
+        self.__sortedItems = None
+        # Built on first use, as indexing takes most of the time of loading a large library. Once
+        # built it is kept up to date with the items
+        self.__searchIndex = None
+        self.__searchIndexLock = threading.Lock()
+        # While the index is built, the changes of the items as (item, added) tuples, which are
+        # applied to the index once the items it started with are indexed
+        self.__pendingIndexChanges = None
+        # Positions of the items in __items by Zotero key
+        self.__idIndex = {}
+        # BibTexEntries of items by (zotInstance, id), retrieved in advance
+        self.__prefetchedBibTex = {}
+        self.__bibTexPrefetchCount = bibTexPrefetchCount
+        self.__recentlyModifiedItems = []
+        self.__maxParallelRequests = maxParallelRequests
+        self.__synced = False
+        self.__lock = threading.RLock()
+        self.__zoteroInstancesLock = threading.Lock()
+        self.__updateLock = threading.Lock()
+        with performanceStats.timed("cache.load"):
+            self.__loadCachedLibrary(zotLibId, "user", zotLibKey)
+        if len(self.__items) > 0:
+            # Index the cached items in the background, so the first search doesn't have to
+            indexer = threading.Thread(target=self.__buildSearchIndex)
+            indexer.daemon = True
+            indexer.start()
+
+    @classmethod
+    def acquire(cls, library, zotLibId, zotLibKey, maxParallelRequests=4, bibTexPrefetchCount=25):
+        """Returns the store for the given credentials, which notifies the library about changes
+        until it is released"""
+        with cls.__storesLock:
+            store = cls.__stores.get((zotLibId, zotLibKey))
+            if store is None:
+                store = ZoteroItemStore(zotLibId, zotLibKey, maxParallelRequests, bibTexPrefetchCount)
+                cls.__stores[(zotLibId, zotLibKey)] = store
+            store.__libraries.append(library)
+            return store
+
+    def release(self, library):
+        with self.__storesLock:
+            if library in self.__libraries:
+                self.__libraries.remove(library)
+            if len(self.__libraries) == 0 and self.__stores.get(self.__credentials) is self:
+                del self.__stores[self.__credentials]
+
+    @property
+    def synced(self):
+        """Whether the store has been synced with Zotero since it was loaded from the cache"""
+        return self.__synced
+
+    @property
+    def itemCount(self):
+        with self.__lock:
+            return len(self.__items)
+
+    @property
+    def sortedItems(self):
+        """The items sorted for the quick panel. It's kept until the store changes, so it must not
+        be modified"""
+        return self.__warmSortedItems()
+
+    def __warmSortedItems(self):
+        """Sorts the items, unless they are sorted already, and returns them"""
+        with self.__lock:
+            if self.__sortedItems is None:
+                self.__sortedItems = sorted(self.__items, key=lambda item: item.sortKey)
+            return self.__sortedItems
+
+    def rank(self, query, limit=50):
+        self.__buildSearchIndex()
+        with self.__lock:
+            return self.__searchIndex.rank(query, limit)
+
+    @timed("store.index")
+    def __buildSearchIndex(self):
+        """Indexes the items for searching unless that's done already, waiting for an indexing
+        in progress. Indexing doesn't hold the store's lock, so the items can be used meanwhile.
+        Items changed in the meantime are indexed afterwards"""
+        with self.__searchIndexLock:
+            with self.__lock:
+                if self.__searchIndex is not None:
+                    return
+                changes = [(item, True) for item in self.__items]
+                self.__pendingIndexChanges = []
+            searchIndex = SearchIndex()
+            while True:
+                for item, added in changes:
+                    if added:
+                        searchIndex.add(item)
+                    else:
+                        searchIndex.remove(item)
+                with self.__lock:
+                    changes = self.__pendingIndexChanges
+                    if len(changes) == 0:
+                        self.__searchIndex = searchIndex
+                        self.__pendingIndexChanges = None
+                        return
+                    self.__pendingIndexChanges = []
+
+    @timed("zotero.sync")
+    def update(self):
+        """Collect all items from Zotero. Zotero libraries which have been synced before are only
+        queried for changes"""
+        with self.__updateLock:
+            self.__recentlyModifiedItems = []
+            pool = WorkerPool(self.__maxParallelRequests)
+            pool.submit(self.__syncLibraryTree, pool, set(), self.__credentials[0], "user", self.__credentials[1])
+            try:
+                pool.join()
+            finally:
+                for zotInstanceIdentifier in self.__zoteroInstances.keys():
+                    self.__saveCachedLibrary(zotInstanceIdentifier)
+            self.__synced = True
+            # Sort now, so opening the quick panel doesn't have to
+            self.__warmSortedItems()
+            if self.__bibTexPrefetchCount > 0 and len(self.__recentlyModifiedItems) > 0:
+                prefetcher = threading.Thread(target=self.__prefetchInBackground, args=(self.__recentlyModifiedItems,))
+                prefetcher.daemon = True
+                prefetcher.start()
+
+    def __notifyLibraries(self, newItems):
+        # Never called while holding the store's lock, as the libraries have locks of their own
+        with self.__storesLock:
+            libraries = list(self.__libraries)
+        for library in libraries:
+            library.zoteroItemsChanged(newItems)
+
+    @timed("store.merge")
+    def __mergeItems(self, newItems):
+        """Merges newItems into the store, replacing already known items"""
+        performanceStats.count("store.mergedItems", len(newItems))
+        with self.__lock:
+            if len(newItems) > 0:
+                self.__sortedItems = None
+            for item in newItems:
+                self.__prefetchedBibTex.pop((item.zotInstance, item.id), None)
+                index = self.__idIndex.get(item.id)
+                if index is not None:
+                    self.__items[index] = item
+                else:
+                    self.__idIndex[item.id] = len(self.__items)
+                    self.__items.append(item)
+                # Adding replaces the item's previous version in the index
+                self.__changeSearchIndex(item, True)
+        self.__notifyLibraries(newItems)
+
+    def __changeSearchIndex(self, item, added):
+        """Adds the item to or removes it from the search index, if it's built or being built.
+        Must be called holding the store's lock"""
+        if self.__searchIndex is not None:
+            if added:
+                self.__searchIndex.add(item)
+            else:
+                self.__searchIndex.remove(item)
+        elif self.__pendingIndexChanges is not None:
+            self.__pendingIndexChanges.append((item, added))
+
+    def __removeZoteroItems(self, zotInstanceIdentifier, keys):
+        """Removes the items with the given keys of a Zotero library. Cited copies of them are
+        kept by the libraries citing them"""
+        keys = set(keys)
+        if len(keys) == 0:
+            return
+        with self.__lock:
+            keptItems = []
+            for item in self.__items:
+                if item.zotInstance != zotInstanceIdentifier or item.id not in keys:
+                    keptItems.append(item)
+                else:
+                    self.__changeSearchIndex(item, False)
+            self.__items = keptItems
+            self.__idIndex = {}
+            for index in xrange(len(self.__items)):
+                self.__idIndex[self.__items[index].id] = index
+            self.__sortedItems = None
+        self.__notifyLibraries([])
+
+    @timed("zotero.bibTexEntry")
+    def bibTexEntryForLibItem(self, libItem):
         """creates an corresponding BibTexEntry for the given Library Item. If it is not possible to
         retrieve a new one None is returned"""
-        with self.__zoteroLock:
+        bibTexEntry = self.__prefetchedBibTex.get((libItem.zotInstance, libItem.id))
+        if bibTexEntry is not None:
+            return bibTexEntry
+        with self.__zoteroLocks[libItem.zotInstance]:
             try:
-                bibTexEntry = BibTexEntry(self.__zoteroInstances[libItem.zotInstance].item(libItem.id, content='bibtex')[0])
+                # Since version 3 of the API, content is only honoured for the Atom format
+                bibTexEntry = BibTexEntry(self.__zoteroInstances[libItem.zotInstance].item(
+                    libItem.id, format='atom', content='bibtex')[0])
             except AttributeError:
                 return libItem.bibTexEntry
             else:
                 bibTexEntry.zoteroLink(libItem.id, libItem.zotInstance[0], libItem.zotInstance[1])
                 return bibTexEntry
 
+    @timed("zotero.bibTexEntries")
+    def bibTexEntriesForLibItems(self, libItems):
+        """Retrieves the BibTexEntries for the given Zotero items in as few requests as possible.
+        Returns a dict from (zotInstance, id) to BibTexEntry"""
+        retVal = {}
+        idsByInstance = {}
+        for libItem in libItems:
+            if libItem.id is not None and libItem.zotInstance in self.__zoteroInstances:
+                idsByInstance.setdefault(libItem.zotInstance, []).append(libItem.id)
+        for zotInstanceIdentifier, ids in idsByInstance.items():
+            zotInstance = self.__zoteroInstances[zotInstanceIdentifier]
+            for start in xrange(0, len(ids), self.__zoteroBatchSize):
+                with self.__zoteroLocks[zotInstanceIdentifier]:
+                    bibTexStrings = zotInstance.get_subset(
+                        ids[start:start + self.__zoteroBatchSize], format='atom', content='bibtex')
+                    keys = zotInstance.item_keys
+                for key, bibTexString in zip(keys, bibTexStrings):
+                    bibTexEntry = BibTexEntry(bibTexString)
+                    bibTexEntry.zoteroLink(key, zotInstanceIdentifier[0], zotInstanceIdentifier[1])
+                    retVal[(zotInstanceIdentifier, key)] = bibTexEntry
+        return retVal
+
+    def hasPrefetchedBibTex(self, libItem):
+        return (libItem.zotInstance, libItem.id) in self.__prefetchedBibTex
+
+    def prefetchBibTex(self, libItems):
+        """Retrieves the BibTexEntries of the given items in advance, so citing them later
+        doesn't have to wait for Zotero"""
+        libItems = [libItem for libItem in libItems if (libItem.zotInstance, libItem.id) not in self.__prefetchedBibTex]
+        self.__prefetchedBibTex.update(self.bibTexEntriesForLibItems(libItems))
+
+    def __prefetchInBackground(self, libItems):
+        try:
+            self.prefetchBibTex(libItems[:self.__bibTexPrefetchCount])
+        except Exception, e:
+            print "Warning: Couldn't prefetch BibTex-entries: %s" % e
+
     def __addZoteroInstance(self, libId, libType, key=None):
-        zotInstanceIdentifier = (libId, libType)
-        if zotInstanceIdentifier not in self.__zoteroInstances.keys():
-            self.__zoteroInstances[zotInstanceIdentifier] = zotero.Zotero(libId, libType, key)
+        # Identifiers are unicode so they match the ones read from BibTex-files
+        zotInstanceIdentifier = (unicode(libId), unicode(libType))
+        with self.__zoteroInstancesLock:
+            if zotInstanceIdentifier not in self.__zoteroInstances:
+                self.__zoteroInstances[zotInstanceIdentifier] = importZotero().Zotero(libId, libType, key, api_version=self.__zoteroApiVersion)
+                # Zotero instances aren't thread safe, so every one has its own lock
+                self.__zoteroLocks[zotInstanceIdentifier] = threading.RLock()
         return zotInstanceIdentifier
 
-    def __getAllUserItems(self, userId, key):
-        zotInstanceIdentifier = self.__addZoteroInstance(userId, "user", key)
-        retVal = []
-        with self.__zoteroLock:
-            libItems = self.__zoteroInstances[zotInstanceIdentifier].top()
-        for libItemDict in libItems:
-            retVal.append(LibraryItem.initFromZotero(zotInstanceIdentifier, libItemDict))
-        with self.__zoteroLock:
-            groups = self.__zoteroInstances[zotInstanceIdentifier].groups()
-        for group in groups:
-            retVal += self.__getAllGroupItems(group[u'group_id'], key)
-        return retVal
+    def __iterZoteroPages(self, zotInstanceIdentifier, method, **kwargs):
+        """Calls the given read method of a Zotero instance and yields its result page by page,
+        following the 'next' links until the last page was retrieved. Each page is yielded
+        together with the library version the server reported for it"""
+        zotInstance = self.__zoteroInstances[zotInstanceIdentifier]
+        zotLock = self.__zoteroLocks[zotInstanceIdentifier]
+        with zotLock:
+            page = getattr(zotInstance, method)(**kwargs)
+            links = zotInstance.links
+            libraryVersion = zotInstance.library_version
+        yield page, libraryVersion
+        while links and links.get('next') and links.get('self') != links.get('last'):
+            with zotLock:
+                # The instance might have been used for other requests in between
+                zotInstance.links = links
+                page = zotInstance.follow()
+                links = zotInstance.links
+                libraryVersion = zotInstance.library_version
+            yield page, libraryVersion
 
-    def __getAllGroupItems(self, groupId, key):
-        zotInstanceIdentifier = self.__addZoteroInstance(groupId, "group", key)
-        retVal = []
-        with self.__zoteroLock:
-            libItems = self.__zoteroInstances[zotInstanceIdentifier].top()
-        for libItemDict in libItems:
-            retVal.append(LibraryItem.initFromZotero(zotInstanceIdentifier, libItemDict))
-        with self.__zoteroLock:
-            groups = self.__zoteroInstances[zotInstanceIdentifier].groups()
-        for group in groups:
-            retVal += self.__getAllGroupItems(group[u'group_id'], key)
-        return retVal
+    def __iterLibraryItems(self, zotInstanceIdentifier):
+        """Yields lists of LibraryItems page by page. If the library has been synced before, only
+        the items modified since then are retrieved and the ones deleted since then are removed"""
+        lastVersion = self.__libraryVersions.get(zotInstanceIdentifier)
+        # Most recently modified items first, as those are the most likely ones to be cited next
+        # format=json is parsed in a single pass, unlike the Atom feeds
+        kwargs = {'limit': self.__zoteroPageSize, 'sort': 'dateModified', 'format': 'json'}
+        if lastVersion is not None:
+            kwargs['since'] = lastVersion
+        newVersion = None
+        for libItemDicts, libraryVersion in self.__iterZoteroPages(zotInstanceIdentifier, 'top', **kwargs):
+            if newVersion is None:
+                newVersion = libraryVersion
+            performanceStats.count("zotero.items", len(libItemDicts))
+            with performanceStats.timed("zotero.convert"):
+                libItems = [LibraryItem.initFromZotero(zotInstanceIdentifier, libItemDict) for libItemDict in libItemDicts]
+            yield libItems
+        if lastVersion is not None and newVersion != lastVersion:
+            with self.__zoteroLocks[zotInstanceIdentifier]:
+                deleted = self.__zoteroInstances[zotInstanceIdentifier].deleted(since=lastVersion)
+            self.__removeZoteroItems(zotInstanceIdentifier, deleted.get(u'items', []))
+        # Only remember the version once the library has been synced completely
+        self.__libraryVersions[zotInstanceIdentifier] = newVersion
+
+    def __iterGroupIds(self, zotInstanceIdentifier):
+        for groups, _ in self.__iterZoteroPages(zotInstanceIdentifier, 'groups', limit=self.__zoteroPageSize, format='json'):
+            for group in groups:
+                yield group[u'group_id']
+
+    def __syncLibraryTree(self, pool, scheduled, libId, libType, key):
+        """Schedules the sync of a Zotero library and, once they are known, of all its groups"""
+        zotInstanceIdentifier = self.__addZoteroInstance(libId, libType, key)
+        with self.__zoteroInstancesLock:
+            if zotInstanceIdentifier in scheduled:
+                return
+            scheduled.add(zotInstanceIdentifier)
+        pool.submit(self.__syncLibraryItems, zotInstanceIdentifier)
+        groupIds = list(self.__iterGroupIds(zotInstanceIdentifier))
+        self.__subLibraries[zotInstanceIdentifier] = groupIds
+        for groupId in groupIds:
+            pool.submit(self.__syncLibraryTree, pool, scheduled, groupId, "group", key)
+
+    def __syncLibraryItems(self, zotInstanceIdentifier):
+        firstPage = True
+        for page in self.__iterLibraryItems(zotInstanceIdentifier):
+            self.__mergeItems(page)
+            if firstPage:
+                self.__recentlyModifiedItems.extend(page[:self.__bibTexPrefetchCount])
+                firstPage = False
 
     @staticmethod
-    def __readFromBibFile(filePath):
-        retVal = []
+    def __cachePath(zotInstanceIdentifier):
+        return os.path.join(cache_folder, "%s_%s.cache" % (zotInstanceIdentifier[1], zotInstanceIdentifier[0]))
+
+    def __loadCachedLibrary(self, libId, libType, key):
+        """Merges the items of a Zotero library and its groups as cached by a previous sync"""
+        zotInstanceIdentifier = self.__addZoteroInstance(libId, libType, key)
         try:
-            with codecs.open(filePath, "r", "utf-8") as f:
-                bibTexString = f.read()
+            with open(self.__cachePath(zotInstanceIdentifier), "rb") as f:
+                cached = cPickle.load(f)
         except IOError:
-            return retVal
-        startIndex = 0
-        braceLevel = 0
-        entry = False
-        for i in xrange(0, len(bibTexString)):
-            if entry is True:
-                if bibTexString[i] == u"{":
-                    braceLevel += 1
-                elif bibTexString[i] == u"}":
-                    braceLevel -= 1
-                    if braceLevel == 0:
-                        entry = False
-                        retVal.append(BibTexEntry(bibTexString[startIndex:i+1]))
-            elif bibTexString[i] == u"@":
-                entry = True
-                startIndex = i
-        return retVal
+            return
+        except Exception, e:
+            print "Warning: Ignoring unreadable cache for %s(%s): %s" % (zotInstanceIdentifier + (e,))
+            return
+        if cached.get('format') != self.__cacheFormat:
+            return
+        self.__libraryVersions[zotInstanceIdentifier] = cached['version']
+        self.__subLibraries[zotInstanceIdentifier] = cached['groups']
+        self.__cachedStates[zotInstanceIdentifier] = (cached['version'], cached['groups'])
+        self.__mergeItems([LibraryItem(row[0], zotInstanceIdentifier, row[1], row[2], row[3], row[4], tags=row[5])
+                           for row in cached['items']])
+        for groupId in cached['groups']:
+            self.__loadCachedLibrary(groupId, "group", key)
+
+    @timed("cache.save")
+    def __saveCachedLibrary(self, zotInstanceIdentifier):
+        """Writes the items of a Zotero library to the cache, unless they are already cached"""
+        state = (self.__libraryVersions.get(zotInstanceIdentifier), self.__subLibraries.get(zotInstanceIdentifier, []))
+        if state[0] is None or self.__cachedStates.get(zotInstanceIdentifier) == state:
+            return
+        with self.__lock:
+            rows = [(item.id, item.authors, item.title, item.year, item.abstract, item.tags)
+                    for item in self.__items if item.zotInstance == zotInstanceIdentifier]
+        cached = {
+            'format': self.__cacheFormat,
+            'version': state[0],
+            'groups': state[1],
+            'items': rows
+        }
+        cachePath = self.__cachePath(zotInstanceIdentifier)
+        try:
+            if not os.path.isdir(cache_folder):
+                os.makedirs(cache_folder)
+            with open(cachePath + ".tmp", "wb") as f:
+                cPickle.dump(cached, f, cPickle.HIGHEST_PROTOCOL)
+            replace_file(cachePath + ".tmp", cachePath)
+        except (IOError, OSError), e:
+            print "Warning: Couldn't write cache for %s(%s): %s" % (zotInstanceIdentifier + (e,))
+        else:
+            self.__cachedStates[zotInstanceIdentifier] = state
+
+
+class SearchIndex(object):
+    """Inverted index of library items, by trigram for their authors, title, year, tags and citekey
+    and by word for their abstract. Items are ranked by the share of the query they match"""
+    __words = re.compile("\\w+", re.U)
+    __abstractWeight = 0.5
+    __maxAbstractWords = 100
+    __minScore = 0.5
+
+    def __init__(self):
+        self.__items = {}
+        self.__trigramPostings = {}
+        self.__wordPostings = {}
+
+    def add(self, item):
+        """Adds the item to the index, replacing an equal one"""
+        self.remove(item)
+        key = self.__itemKey(item)
+        self.__items[key] = item
+        trigrams, words = self.__termsOf(item)
+        for trigram in trigrams:
+            self.__trigramPostings.setdefault(trigram, set()).add(key)
+        for word in words:
+            self.__wordPostings.setdefault(word, set()).add(key)
+
+    def remove(self, item):
+        """Removes the item equal to the given one from the index"""
+        indexedItem = self.__items.pop(self.__itemKey(item), None)
+        if indexedItem is None:
+            return
+        key = self.__itemKey(indexedItem)
+        trigrams, words = self.__termsOf(indexedItem)
+        for postings, terms in ((self.__trigramPostings, trigrams), (self.__wordPostings, words)):
+            for term in terms:
+                posting = postings.get(term)
+                if posting is not None:
+                    posting.discard(key)
+                    if len(posting) == 0:
+                        del postings[term]
+
+    def search(self, query, limit=50):
+        return [result[-1] for result in self.rank(query, limit)]
+
+    def rank(self, query, limit=50):
+        """Returns the best matching items as (-score, sortKey, key, item) tuples, best match first"""
+        trigramPostings = [self.__trigramPostings.get(trigram, frozenset()) for trigram in self.__trigramsOf(query)]
+        wordPostings = [self.__wordPostings.get(word, frozenset()) for word in self.__abstractWordsOf(query)]
+        if len(trigramPostings) == 0:
+            return []
+        trigramPostings.sort(key=len)
+        wordPostings.sort(key=len)
+        # An item matching enough trigrams has to match at least one of the rarest ones
+        neededTrigrams = int(len(trigramPostings) * self.__minScore + 0.5)
+        candidates = set()
+        for posting in trigramPostings[:len(trigramPostings) - neededTrigrams + 1]:
+            candidates.update(posting)
+        if len(wordPostings) > 0:
+            candidates.update(wordPostings[0])
+        ranked = []
+        for key in candidates:
+            score = sum([1.0 for posting in trigramPostings if key in posting]) / len(trigramPostings)
+            if len(wordPostings) > 0:
+                score += self.__abstractWeight * sum([1.0 for posting in wordPostings if key in posting]) / len(wordPostings)
+            if score >= self.__minScore:
+                ranked.append((-score, self.__items[key].sortKey, key, self.__items[key]))
+        return heapq.nsmallest(limit, ranked)
 
     @staticmethod
-    def __writeToBibFile(bibTexEntries, filePath):
-        with codecs.open(filePath, "w", "utf-8") as f:
-            f.writelines([entry.bibTexString + "\n" for entry in bibTexEntries])
+    def __itemKey(item):
+        if item.id is not None:
+            return item.id
+        return u"@" + item.bibTexEntry.key
+
+    @classmethod
+    def __termsOf(cls, item):
+        citeKey = item.bibTexEntry.key if item.bibTexEntry is not None else None
+        text = u" ".join([unicode(value) for value in (item.authors, item.title, item.year, item.tags, citeKey) if value])
+        return cls.__trigramsOf(text), cls.__abstractWordsOf(item.abstract or u"")
+
+    @classmethod
+    def __trigramsOf(cls, text):
+        trigrams = set()
+        for word in cls.__words.findall(text.lower()):
+            word = u" %s " % word
+            for i in xrange(len(word) - 2):
+                trigrams.add(word[i:i + 3])
+        return trigrams
+
+    @classmethod
+    def __abstractWordsOf(cls, text):
+        words = set()
+        for word in cls.__words.findall(text.lower()):
+            if len(word) > 2:
+                words.add(word)
+                if len(words) == cls.__maxAbstractWords:
+                    break
+        return words
+
+
+class WorkerPool(object):
+    """Runs submitted tasks on at most maxWorkers threads. Tasks may submit further tasks to the
+    pool. join() waits until all tasks are done and re-raises the first exception of a task"""
+
+    def __init__(self, maxWorkers):
+        self.__maxWorkers = max(1, maxWorkers)
+        self.__tasks = Queue.Queue()
+        self.__lock = threading.Condition()
+        self.__pending = 0
+        self.__workers = []
+        self.__error = None
+
+    def submit(self, func, *args):
+        with self.__lock:
+            self.__pending += 1
+            self.__tasks.put((func, args))
+            if len(self.__workers) < min(self.__maxWorkers, self.__pending):
+                worker = threading.Thread(target=self.__work)
+                worker.daemon = True
+                worker.start()
+                self.__workers.append(worker)
+
+    def join(self):
+        with self.__lock:
+            while self.__pending > 0:
+                self.__lock.wait()
+            for worker in self.__workers:
+                self.__tasks.put(None)
+        for worker in self.__workers:
+            worker.join()
+        if self.__error is not None:
+            raise self.__error[0], self.__error[1], self.__error[2]
+
+    def __work(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                return
+            try:
+                # After a failure the remaining tasks are only drained
+                if self.__error is None:
+                    task[0](*task[1])
+            except Exception:
+                with self.__lock:
+                    if self.__error is None:
+                        self.__error = sys.exc_info()
+            finally:
+                with self.__lock:
+                    self.__pending -= 1
+                    if self.__pending == 0:
+                        self.__lock.notifyAll()
 
 
 class LibraryItem(object):
-    def __init__(self, docId=None, zotInstance=None, authors=None, title=None, year=None, abstract=None, bibTexEntry=None):
+    # Libraries easily hold tens of thousands of items, so they are kept compact
+    __slots__ = ("id", "zotInstance", "authors", "title", "year", "tags", "bibTexEntry", "__abstract", "__menuRows")
+    # Changing one of these invalidates the cached menuRows. They are cached UTF-8 encoded and
+    # joined by this separator, which takes less than a fourth of the memory of a list of rows
+    __menuRowSeparator = "\0"
+    __displayedAttributes = frozenset(["id", "authors", "title", "year", "abstract"])
+    # Abstracts longer than this are kept zlib compressed
+    __maxUncompressedAbstract = 200
+    # Values shared by many items, library identifiers and bare years, are only kept once. Full
+    # dates are mostly unique, so they aren't, which keeps the table as small as these values
+    __internedValues = {}
+    __sharedYear = re.compile(u"^(\\d{1,4}|\\?{4})$")
+
+    def __init__(self, docId=None, zotInstance=None, authors=None, title=None, year=None, abstract=None, bibTexEntry=None,
+                 tags=None):
         if docId is None and bibTexEntry is None:
             raise ValueError("LibraryItem needs at least either a docId or a bibTexEntry")
+        self.__menuRows = None
         self.id = docId
-        self.zotInstance = zotInstance
+        self.zotInstance = LibraryItem.__intern(zotInstance)
         self.authors = authors
         self.title = title
-        self.year = year
+        self.year = LibraryItem.__intern(year) if year is not None and LibraryItem.__sharedYear.match(year) else year
         self.abstract = abstract
         self.bibTexEntry = bibTexEntry
+        self.tags = tags
 
     @property
     def cited(self):
         return self.bibTexEntry is not None
 
+    @property
+    def abstract(self):
+        abstract = self.__abstract
+        if isinstance(abstract, bytearray):
+            return zlib.decompress(str(abstract)).decode("utf-8")
+        return abstract
+
+    @abstract.setter
+    def abstract(self, value):
+        if isinstance(value, unicode) and len(value) > LibraryItem.__maxUncompressedAbstract:
+            value = bytearray(zlib.compress(value.encode("utf-8")))
+        self.__abstract = value
+
+    @staticmethod
+    def __intern(value):
+        if value is None:
+            return None
+        return LibraryItem.__internedValues.setdefault(value, value)
+
+    def withBibTexEntry(self, bibTexEntry):
+        """Returns a cited copy of the item"""
+        return LibraryItem(self.id, self.zotInstance, self.authors, self.title, self.year, self.abstract, bibTexEntry,
+                           self.tags)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in LibraryItem.__displayedAttributes:
+            object.__setattr__(self, "_LibraryItem__menuRows", None)
+
     @property
     def menuRows(self):
+        """The rows shown in the quick panel, computed once"""
+        return self.__encodedMenuRows().decode("utf-8").split(LibraryItem.__menuRowSeparator)
+
+    @property
+    def sortKey(self):
+        """The first menu row, still UTF-8 encoded. Encoded strings sort like the decoded ones, so
+        sorting doesn't have to decode them"""
+        menuRows = self.__encodedMenuRows()
+        end = menuRows.find(LibraryItem.__menuRowSeparator)
+        return menuRows if end == -1 else menuRows[:end]
+
+    def __encodedMenuRows(self):
+        if self.__menuRows is None:
+            self.__menuRows = LibraryItem.__menuRowSeparator.join(
+                [unicode(row).encode("utf-8") for row in self.__computeMenuRows()])
+        return self.__menuRows
+
+    def __computeMenuRows(self):
         retVal = []
         searchableRow = "%s (%s): %s" % (self.authors, self.year, self.title)
         if len(searchableRow) > 100:
@@ -293,7 +1173,8 @@ class LibraryItem(object):
             LibraryItem.__decodeAuthors(libItemDict[u'creators']),
             libItemDict.get(u'title', "No Title"),
             libItemDict.get(u'date', "????"),
-            libItemDict.get(u'abstractNote', "")
+            libItemDict.get(u'abstractNote', ""),
+            tags=u"; ".join([tag[u'tag'] for tag in libItemDict.get(u'tags', [])])
         )
 
     @staticmethod
@@ -306,26 +1187,142 @@ class LibraryItem(object):
         return retVal
 
 
+class BibTexReader(object):
+    """Iterates over the source strings of the entries in a BibTex-file. The file is read in chunks
+    and scanned for the delimiters only, so memory is bounded by the chunk and entry size.
+    @comment, @preamble and @string entries and the text between entries aren't yielded, but
+    appended to rawBlocks if it is given, so they can be written back as they were"""
+    __entryHead = re.compile("@\\s*(\\w+)\\s*([{(])")
+    __maxEntryHeadLength = 256
+    __delimiters = re.compile(u'[{}")]')
+    __rawTypes = ("comment", "preamble", "string")
+
+    def __init__(self, fileObj, chunkSize=65536, rawBlocks=None):
+        self.__file = fileObj
+        self.__chunkSize = chunkSize
+        self.__rawBlocks = rawBlocks
+
+    def __iter__(self):
+        buf = u""
+        pos = 0
+        # The text in buf from textStart on isn't part of an entry. Once buf is replaced, that
+        # text is collected in text
+        textStart = 0
+        text = []
+        while True:
+            start = buf.find(u"@", pos)
+            if start == -1:
+                text.append(buf[textStart:])
+                buf = self.__file.read(self.__chunkSize)
+                pos = textStart = 0
+                if not buf:
+                    break
+                continue
+            head = self.__entryHead.match(buf, start)
+            if head is None:
+                if len(buf) - start < self.__maxEntryHeadLength:
+                    # The head of the entry might continue in the next chunk
+                    chunk = self.__file.read(self.__chunkSize)
+                    if chunk:
+                        text.append(buf[textStart:start])
+                        buf = buf[start:] + chunk
+                        pos = textStart = 0
+                        continue
+                pos = start + 1
+                continue
+            text.append(buf[textStart:start])
+            entryType = head.group(1).lower()
+            parenthesized = head.group(2) == u"("
+            braceLevel = 1
+            quoted = False
+            end = None
+            scanPos = head.end()
+            while end is None:
+                for match in self.__delimiters.finditer(buf, scanPos):
+                    char = match.group()
+                    if char == u"{":
+                        braceLevel += 1
+                    elif char == u"}":
+                        braceLevel -= 1
+                        if braceLevel == 0:
+                            end = match.end()
+                            break
+                    elif braceLevel == 1:
+                        # Outside of braced values quotes delimit values
+                        if char == u'"':
+                            quoted = not quoted
+                        elif parenthesized and not quoted:
+                            end = match.end()
+                            break
+                else:
+                    chunk = self.__file.read(self.__chunkSize)
+                    if not chunk:
+                        # Unterminated entry at the end of the file, which is kept as text
+                        end = len(buf)
+                        entryType = None
+                        break
+                    scanPos = len(buf) - start
+                    buf = buf[start:] + chunk
+                    start = 0
+            self.__addRawBlock(u"".join(text))
+            text = []
+            if entryType is None or entryType in self.__rawTypes:
+                self.__addRawBlock(buf[start:end])
+            else:
+                yield buf[start:end]
+            pos = textStart = end
+        self.__addRawBlock(u"".join(text))
+
+    def __addRawBlock(self, block):
+        # The whitespace around blocks is written anew
+        block = block.strip()
+        if self.__rawBlocks is not None and len(block) > 0:
+            self.__rawBlocks.append(block)
+
+
 class BibTexEntry(object):
-    __valueInCurlyBraces = re.compile("\\{(.*)\\}", re.S)
+    """A BibTex-entry which keeps its source string and only parses the fields when they are first
+    accessed. Unless its fields are modified the entry is written back as it was read"""
+    __entryHead = re.compile("@\\s*(\\w+)\\s*[{(]\\s*([^,\\s]+?)\\s*,")
+    __fieldName = re.compile("\\s*([^\\s=,{}()\"#]+)\\s*=\\s*")
+    __bareValue = re.compile("[^\\s,{}()\"#]*")
+    __concatenation = re.compile("\\s*#\\s*")
+    __braces = re.compile("[{}]")
+    __bracesOrQuote = re.compile('[{}"]')
 
     def __init__(self, bibTexString):
         bibTexString = unicode(bibTexString)
-        bibTexEntryMatch = re.search("@(\\S+?)\\s*\\{\\s*(\\S+?)\\s*,(.*)\\}", bibTexString, re.S)
+        bibTexEntryMatch = self.__entryHead.search(bibTexString)
         if bibTexEntryMatch:
             self.type = bibTexEntryMatch.group(1)
             self.key = bibTexEntryMatch.group(2)
-            self.entrys = {}
-            for match in re.finditer("(\\S+?)\\s*=\\s*(.*?),?\\n", bibTexEntryMatch.group(3)):
-                self.entrys[match.group(1)] = match.group(2)
+            self.__source = bibTexString
+            self.__fieldsStart = bibTexEntryMatch.end()
+            self.__fieldSpans = None
+            self.__values = {}
+            self.__entrys = None
         else:
             raise ValueError("Passed string doesn't contain a valid BiBTex-Entry")
 
+    @property
+    def entrys(self):
+        """All fields as a dict from field name to its raw value. Modifications of the dict are
+        written by bibTexString"""
+        if self.__entrys is None:
+            entrys = {}
+            for name, start, end in self.__spans().values():
+                entrys[name] = self.__source[start:end]
+            self.__entrys = entrys
+            self.__values = {}
+        return self.__entrys
+
     @property
     def bibTexString(self):
+        if self.__entrys is None:
+            return self.__source
         entrysString = ""
-        for key in self.entrys.keys():
-            entrysString += "\t%s = %s,\n" % (key, self.entrys[key])
+        for key in self.__entrys.keys():
+            entrysString += "\t%s = %s,\n" % (key, self.__entrys[key])
         return u"@%s{%s,\n%s}" % (self.type, self.key, entrysString)
 
     @property
@@ -358,9 +1355,77 @@ class BibTexEntry(object):
 
     def __getEntry(self, entry, default=""):
         try:
-            return self.__valueInCurlyBraces.search(self.entrys.get(entry, "")).group(1)
-        except AttributeError:
+            return self.__values[entry]
+        except KeyError:
+            pass
+        if self.__entrys is not None:
+            rawValue = self.__entrys.get(entry)
+            if rawValue is None:
+                for name in self.__entrys.keys():
+                    if name.lower() == entry:
+                        rawValue = self.__entrys[name]
+        else:
+            span = self.__spans().get(entry)
+            rawValue = span and self.__source[span[1]:span[2]]
+        if not rawValue:
             return default
+        if rawValue[0] in u'{"' and rawValue[-1] == {u"{": u"}", u'"': u'"'}[rawValue[0]]:
+            value = rawValue[1:-1]
+        else:
+            value = rawValue
+        self.__values[entry] = value
+        return value
+
+    def __spans(self):
+        """Returns the positions of the field values in the source by lower case field name,
+        locating them on first use"""
+        if self.__fieldSpans is None:
+            spans = {}
+            source = self.__source
+            pos = self.__fieldsStart
+            while True:
+                match = self.__fieldName.match(source, pos)
+                if match is None:
+                    break
+                end = self.__valueEnd(source, match.end())
+                spans[match.group(1).lower()] = (match.group(1), match.end(), end)
+                pos = end
+                while pos < len(source) and source[pos] in u" \t\r\n,":
+                    pos += 1
+            self.__fieldSpans = spans
+        return self.__fieldSpans
+
+    @classmethod
+    def __valueEnd(cls, source, pos):
+        """Returns the end of the (possibly concatenated) value starting at pos"""
+        while True:
+            if source.startswith(u"{", pos):
+                braceLevel = 0
+                for match in cls.__braces.finditer(source, pos):
+                    braceLevel += 1 if match.group() == u"{" else -1
+                    if braceLevel == 0:
+                        pos = match.end()
+                        break
+                else:
+                    return len(source)
+            elif source.startswith(u'"', pos):
+                braceLevel = 0
+                for match in cls.__bracesOrQuote.finditer(source, pos + 1):
+                    if match.group() == u"{":
+                        braceLevel += 1
+                    elif match.group() == u"}":
+                        braceLevel -= 1
+                    elif braceLevel == 0:
+                        pos = match.end()
+                        break
+                else:
+                    return len(source)
+            else:
+                pos = cls.__bareValue.match(source, pos).end()
+            concatenation = cls.__concatenation.match(source, pos)
+            if concatenation is None:
+                return pos
+            pos = concatenation.end()
 
     def zoteroLink(self, key, libId, libType):
         self.entrys["zoterodocid"] = "{%s}" % key
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""Tests for reading and writing BibTex-files. Sublime Text is stood in for by benchmarks/sublime.py,
+run them with the Python 2 interpreter from the package folder:
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import subprocess
+import urllib2
+import urlparse
+import httplib
+import tempfile
+import unittest
+from StringIO import StringIO
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(1, os.path.join(root, "benchmarks"))
+for lib in ("pyzotero", "feedparser", "pytz-2013b", "poster-0.8.1", "ordereddict-1.1"):
+    sys.path.append(os.path.join(root, "lib", lib))
+
+import json
+import library
+from library import Library, LibraryItem, SearchIndex, BibTexReader, BibTexEntry
+from fakezotero import FakeZoteroServer
+
+bibFile = u"""% Exported from Zotero
+@string{jzot = "Journal of {Z}otero Studies"}
+@preamble{"\\newcommand{\\noop}[1]{}"}
+
+@article{doe2001,
+\tTitle = {The {Zotero} Book},
+\tAUTHOR = "Doe, John and {Smith}, Jane",
+\tjournal = jzot,
+\tmonth = jan # " 1",
+\tabstract = {First line
+second line
+third line},
+\tzoterodocid = {ABCD1234}
+}
+@comment{jabref-meta: groupsversion:3;}
+@Book(roe1999,
+  title = "Quoted {"}braces{"} (and parentheses)",
+  year = 1999
+)
+Some text between entries
+@misc{last, title = {Last}}
+"""
+
+
+atomFeed = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:zapi="http://zotero.org/ns/api">
+  <title>Items</title>
+  <entry>
+    <title>A</title>
+    <zapi:key>ABCD1234</zapi:key>
+    <content type="text">@article{doe2001,
+	title = {The {Zotero} Book}
+}</content>
+  </entry>
+</feed>"""
+
+
+class AtomHTTPSHandler(urllib2.HTTPSHandler):
+    """Answers every request with atomFeed and keeps the requested URLs"""
+
+    def __init__(self):
+        urllib2.HTTPSHandler.__init__(self)
+        self.urls = []
+
+    def https_open(self, req):
+        self.urls.append(req.get_full_url())
+        response = urllib2.addinfourl(StringIO(atomFeed), httplib.HTTPMessage(StringIO(
+            "Content-Type: application/atom+xml\r\n")), req.get_full_url())
+        response.code = 200
+        response.msg = "OK"
+        return response
+
+
+class View(object):
+    """Stand-in for the Sublime Text view a library belongs to"""
+
+    def __init__(self, bufferId):
+        self.bufferId = bufferId
+
+    def buffer_id(self):
+        return self.bufferId
+
+    def file_name(self):
+        return None
+
+
+class TestBibTexReader(unittest.TestCase):
+    def read(self, source, chunkSize=65536):
+        rawBlocks = []
+        entries = list(BibTexReader(StringIO(source), chunkSize, rawBlocks))
+        return entries, rawBlocks
+
+    def testSplitsEntries(self):
+        entries, rawBlocks = self.read(bibFile)
+        self.assertEqual([entry.split(u"{", 1)[0].split(u"(", 1)[0] for entry in entries],
+                         [u"@article", u"@Book", u"@misc"])
+        self.assertTrue(entries[0].endswith(u"{ABCD1234}\n}"))
+        self.assertTrue(entries[1].endswith(u"year = 1999\n)"))
+        self.assertEqual(entries[2], u"@misc{last, title = {Last}}")
+
+    def testEntriesAcrossChunks(self):
+        expected = self.read(bibFile)
+        for chunkSize in (1, 2, 3, 7, 16, 100):
+            self.assertEqual(self.read(bibFile, chunkSize), expected)
+
+    def testKeepsRawBlocks(self):
+        rawBlocks = self.read(bibFile)[1]
+        self.assertEqual(rawBlocks, [
+            u"% Exported from Zotero",
+            u'@string{jzot = "Journal of {Z}otero Studies"}',
+            u'@preamble{"\\newcommand{\\noop}[1]{}"}',
+            u"@comment{jabref-meta: groupsversion:3;}",
+            u"Some text between entries"])
+
+    def testUnterminatedEntry(self):
+        entries, rawBlocks = self.read(u"@misc{a, title={A}}\n@misc{b, title={B")
+        self.assertEqual(entries, [u"@misc{a, title={A}}"])
+        self.assertEqual(rawBlocks, [u"@misc{b, title={B"])
+
+    def testAtSignInText(self):
+        entries, rawBlocks = self.read(u"mail@example.org\n@misc{a, title={A}}", 4)
+        self.assertEqual(entries, [u"@misc{a, title={A}}"])
+        self.assertEqual(rawBlocks, [u"mail@example.org"])
+
+
+class TestBibTexEntry(unittest.TestCase):
+    def setUp(self):
+        self.entries = [BibTexEntry(source) for source in BibTexReader(StringIO(bibFile))]
+
+    def testHead(self):
+        self.assertEqual([(entry.type, entry.key) for entry in self.entries],
+                         [(u"article", u"doe2001"), (u"Book", u"roe1999"), (u"misc", u"last")])
+
+    def testMixedCaseFieldNames(self):
+        entry = self.entries[0]
+        self.assertEqual(entry.title, u"The {Zotero} Book")
+        self.assertEqual(entry.author, u"Doe, John and {Smith}, Jane")
+        self.assertEqual(entry.zoteroKey, u"ABCD1234")
+
+    def testMultiLineValue(self):
+        self.assertEqual(self.entries[0].abstract, u"First line\nsecond line\nthird line")
+
+    def testConcatenation(self):
+        entrys = self.entries[0].entrys
+        self.assertEqual(entrys[u"month"], u'jan # " 1"')
+        self.assertEqual(entrys[u"journal"], u"jzot")
+        self.assertEqual(entrys[u"zoterodocid"], u"{ABCD1234}")
+
+    def testParenthesizedEntryWithQuotedBraces(self):
+        entry = self.entries[1]
+        self.assertEqual(entry.title, u'Quoted {"}braces{"} (and parentheses)')
+        self.assertEqual(entry.year, u"1999")
+
+    def testDefaults(self):
+        entry = self.entries[2]
+        self.assertEqual(entry.author, "No Author(s)")
+        self.assertEqual(entry.zoteroKey, None)
+
+    def testUnmodifiedEntryIsWrittenUnchanged(self):
+        sources = list(BibTexReader(StringIO(bibFile)))
+        for entry, source in zip(self.entries, sources):
+            entry.title
+            entry.zoteroKey
+            self.assertEqual(entry.bibTexString, source)
+
+    def testModifiedEntry(self):
+        entry = self.entries[2]
+        entry.zoteroLink(u"KEY", u"123", u"user")
+        self.assertEqual(BibTexEntry(entry.bibTexString).zoteroKey, u"KEY")
+        self.assertEqual(BibTexEntry(entry.bibTexString).title, u"Last")
+
+    def testInvalidEntry(self):
+        self.assertRaises(ValueError, BibTexEntry, u"no entry")
+
+
+def makeItem(key, authors, title, year=u"2001", abstract=u"", tags=None):
+    return LibraryItem(key, (u"123456", u"user"), authors, title, year, abstract, tags=tags)
+
+
+class TestLibraryItem(unittest.TestCase):
+    def testInternsOnlySharedValues(self):
+        first = makeItem(u"A", u"Doe, J", u"Title", u"".join([u"20", u"01"]))
+        second = makeItem(u"B", u"Doe, J", u"Title", u"".join([u"200", u"1"]))
+        self.assertTrue(first.year is second.year)
+        first = makeItem(u"A", u"Doe, J", u"Title", u"".join([u"2001-03-", u"12"]))
+        second = makeItem(u"B", u"Doe, J", u"Title", u"".join([u"2001-03", u"-12"]))
+        self.assertEqual(first.year, second.year)
+        self.assertFalse(first.year is second.year)
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = SearchIndex()
+        self.items = [
+            makeItem(u"A", u"Doe, J", u"The Zotero Book"),
+            makeItem(u"B", u"Roe, R", u"Zotero for Historians", u"1999"),
+            makeItem(u"C", u"Smith, S", u"Citation Styles", abstract=u"How reference managers format bibliographies"),
+            makeItem(u"D", u"Miller, M", u"Plain Text Writing", tags=u"markdown; pandoc")]
+        for item in self.items:
+            self.index.add(item)
+
+    def search(self, query):
+        return [item.id for item in self.index.search(query)]
+
+    def testRanksBestMatchFirst(self):
+        self.assertEqual(self.search(u"zotero book"), [u"A", u"B"])
+        self.assertEqual(self.search(u"roe zotero 1999")[0], u"B")
+
+    def testMatchesTypos(self):
+        # Enough trigrams of a misspelled word still match
+        self.assertEqual(self.search(u"zoterro"), [u"A", u"B"])
+        self.assertEqual(self.search(u"histrians"), [u"B"])
+
+    def testMatchesTagsAndAbstracts(self):
+        self.assertEqual(self.search(u"pandoc"), [u"D"])
+        self.assertEqual(self.search(u"reference managers"), [u"C"])
+
+    def testNoMatch(self):
+        self.assertEqual(self.search(u"quantum"), [])
+        self.assertEqual(self.search(u""), [])
+
+    def testReplaceAndRemove(self):
+        self.index.add(makeItem(u"A", u"Doe, J", u"Gardening"))
+        self.assertEqual(self.search(u"zotero book"), [u"B"])
+        self.assertEqual(self.search(u"gardening"), [u"A"])
+        self.index.remove(self.items[1])
+        self.assertEqual(self.search(u"zotero"), [])
+
+
+class TestLibrarySave(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cacheFolder = library.cache_folder
+        library.cache_folder = os.path.join(self.directory, "cache")
+        self.path = os.path.join(self.directory, "document.bib")
+        with open(self.path, "wb") as f:
+            f.write(bibFile.encode("utf-8"))
+        self.writes = []
+        self.writeToBibFile = Library._Library__writeToBibFile
+
+        def recordWrite(bibTexStrings, filePath):
+            self.writes.append(filePath)
+            self.writeToBibFile(bibTexStrings, filePath)
+        Library._Library__writeToBibFile = staticmethod(recordWrite)
+        # Without updating from Zotero, so only the BibTex-file is read
+        self.library = Library(View(1), "user", "key", self.path, True)
+        self.library._Library__mergeBibFileItems()
+
+    def tearDown(self):
+        self.library.removeLibraryForView(False)
+        Library._Library__writeToBibFile = staticmethod(self.writeToBibFile)
+        library.cache_folder = self.cacheFolder
+        shutil.rmtree(self.directory, True)
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read().decode("utf-8")
+
+    def testSaveWithoutChangesIsSkipped(self):
+        self.library.save()
+        self.assertEqual(self.writes, [])
+        self.assertEqual(self.read(), bibFile)
+
+    def testSaveKeepsRawBlocks(self):
+        self.library.cite(library.LibraryItem(bibTexEntry=BibTexEntry(u"@misc{new, title={New}}")))
+        self.library.save()
+        self.assertEqual(self.writes, [self.path])
+        saved = self.read()
+        for block in (u"% Exported from Zotero", u'@string{jzot = "Journal of {Z}otero Studies"}',
+                      u"@comment{jabref-meta: groupsversion:3;}", u"Some text between entries"):
+            self.assertTrue(block in saved)
+        self.assertTrue(saved.index(u"@string") < saved.index(u"@article"))
+        # The entries read are written back unchanged
+        for source in BibTexReader(StringIO(bibFile)):
+            self.assertTrue(source in saved)
+        entries = [BibTexEntry(source) for source in BibTexReader(StringIO(saved))]
+        self.assertEqual(sorted([entry.key for entry in entries]), [u"doe2001", u"last", u"new", u"roe1999"])
+        self.library.save()
+        self.assertEqual(len(self.writes), 1)
+
+    def testSaveAfterChangeOnDisk(self):
+        os.remove(self.path)
+        self.library.save()
+        self.assertEqual(self.writes, [self.path])
+        self.assertTrue(os.path.exists(self.path))
+
+
+class TestZoteroItemStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cacheFolder = library.cache_folder
+        library.cache_folder = os.path.join(self.directory, "cache")
+        self.handler = AtomHTTPSHandler()
+        urllib2.install_opener(urllib2.build_opener(self.handler))
+        self.library = Library(View(1), "123456", "key", None, True)
+        self.store = self.library._Library__store
+        self.item = library.LibraryItem(u"ABCD1234", (u"123456", u"user"), u"Doe, J", u"The Zotero Book", u"2001")
+
+    def tearDown(self):
+        self.library.removeLibraryForView(False)
+        urllib2.install_opener(None)
+        library.cache_folder = self.cacheFolder
+        shutil.rmtree(self.directory, True)
+
+    def assertRequestedBibTex(self, path):
+        url = urlparse.urlparse(self.handler.urls[-1])
+        query = urlparse.parse_qs(url.query)
+        self.assertEqual(url.path, path)
+        # The API only honours content for the Atom format since version 3
+        self.assertEqual(query["format"], ["atom"])
+        self.assertEqual(query["content"], ["bibtex"])
+
+    def testBibTexEntryForLibItem(self):
+        bibTexEntry = self.store.bibTexEntryForLibItem(self.item)
+        self.assertRequestedBibTex("/users/123456/items/ABCD1234")
+        self.assertEqual(bibTexEntry.key, u"doe2001")
+        self.assertEqual(bibTexEntry.zoteroKey, u"ABCD1234")
+
+    def merge(self, items):
+        self.store._ZoteroItemStore__mergeItems(items)
+
+    def search(self, query):
+        return [result[-1].id for result in self.store.rank(query)]
+
+    def testSearchIndexFollowsMerges(self):
+        self.merge([makeItem(u"A", u"Doe, J", u"The Zotero Book"), makeItem(u"B", u"Roe, R", u"Gardening")])
+        self.assertEqual(self.search(u"zotero"), [u"A"])
+        self.merge([makeItem(u"A", u"Doe, J", u"Cooking"), makeItem(u"C", u"Poe, E", u"Zotero Again")])
+        self.assertEqual(self.search(u"zotero"), [u"C"])
+        self.assertEqual(self.search(u"cooking"), [u"A"])
+        self.store._ZoteroItemStore__removeZoteroItems((u"123456", u"user"), [u"C"])
+        self.assertEqual(self.search(u"zotero"), [])
+
+    def testMergesDuringIndexingAreIndexed(self):
+        self.merge([makeItem(u"A", u"Doe, J", u"The Zotero Book"), makeItem(u"B", u"Roe, R", u"Gardening")])
+        add = SearchIndex.add
+        merged = []
+
+        def addAndMerge(index, item):
+            add(index, item)
+            if len(merged) == 0:
+                # Another thread syncs while the index is built
+                merged.append(item)
+                self.merge([makeItem(u"A", u"Doe, J", u"Cooking"), makeItem(u"C", u"Poe, E", u"Zotero Again")])
+                self.store._ZoteroItemStore__removeZoteroItems((u"123456", u"user"), [u"B"])
+        SearchIndex.add = addAndMerge
+        try:
+            self.assertEqual(self.search(u"zotero"), [u"C"])
+        finally:
+            SearchIndex.add = add
+        self.assertEqual(self.search(u"cooking"), [u"A"])
+        self.assertEqual(self.search(u"gardening"), [])
+        self.assertEqual(len(merged), 1)
+
+    def testLibrariesShareTheStore(self):
+        other = Library(View(2), "123456", "key", None, True)
+        try:
+            self.assertTrue(other._Library__store is self.store)
+            self.library.panelModel
+            other.panelModel
+            self.merge([makeItem(u"A", u"Doe, J", u"The Zotero Book")])
+            self.assertEqual([item.id for item in self.library.panelModel], [u"A"])
+            self.assertEqual([item.id for item in other.panelModel], [u"A"])
+        finally:
+            other.removeLibraryForView(False)
+        stores = library.ZoteroItemStore._ZoteroItemStore__stores
+        self.assertEqual(stores.values(), [self.store])
+        self.library.removeLibraryForView(False)
+        self.assertEqual(stores, {})
+
+    def testPanelIsSortedAndKeepsRows(self):
+        self.merge([makeItem(u"A", u"\xd8rsted, H", u"Electromagnetism"), makeItem(u"B", u"Zed, Z", u"Last"),
+                    makeItem(u"C", u"\xc5ngstr\xf6m, A", u"Spectra"), makeItem(u"D", u"Abel, N", u"Equations")])
+        items, rows = self.library.panel
+        self.assertEqual([item.id for item in items], [u"D", u"B", u"C", u"A"])
+        self.assertEqual(rows, sorted(rows))
+        self.assertEqual(rows[2][0], u"\xc5ngstr\xf6m, A (2001): Spectra")
+        self.assertTrue(self.library.panel[1] is rows)
+        self.merge([makeItem(u"E", u"Bell, J", u"Inequalities")])
+        items, rows = self.library.panel
+        self.assertEqual([item.id for item in items], [u"D", u"E", u"B", u"C", u"A"])
+
+    def testBibTexEntriesForLibItems(self):
+        bibTexEntries = self.store.bibTexEntriesForLibItems([self.item])
+        self.assertRequestedBibTex("/users/123456/items")
+        self.assertEqual(bibTexEntries.keys(), [((u"123456", u"user"), u"ABCD1234")])
+        self.assertEqual(bibTexEntries.values()[0].title, u"The {Zotero} Book")
+
+
+class TestSync(unittest.TestCase):
+    """Syncs with the stand-in for the Zotero API of the benchmarks"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cacheFolder = library.cache_folder
+        library.cache_folder = os.path.join(self.directory, "cache")
+        self.server = FakeZoteroServer(items=250, groups=0, groupItems=0)
+        self.server.start()
+        from pyzotero import zotero, httpcache, scheduler
+        self.zotero = zotero
+        self.Zotero = zotero.Zotero
+        self.scheduler = scheduler.default
+        self.pace = (self.scheduler.rate, self.scheduler.burst)
+        Zotero = self.Zotero
+        url = self.server.url
+
+        class LocalZotero(Zotero):
+            def __init__(self, *args, **kwargs):
+                Zotero.__init__(self, *args, **kwargs)
+                self.endpoint = url
+        zotero.Zotero = LocalZotero
+        self.scheduler.rate = self.scheduler.burst = 1e9
+        urllib2.install_opener(urllib2.build_opener(
+            httpcache.ConditionalGetProcessor(httpcache.ResponseCache(os.path.join(self.directory, "http")))))
+        self.library = Library(View(1), self.server.userId, "key", None, True, 2, 0)
+        self.store = self.library._Library__store
+
+    def tearDown(self):
+        self.library.removeLibraryForView(False)
+        self.zotero.Zotero = self.Zotero
+        self.scheduler.rate, self.scheduler.burst = self.pace
+        urllib2.install_opener(None)
+        self.server.stop()
+        library.cache_folder = self.cacheFolder
+        shutil.rmtree(self.directory, True)
+
+    def assertInSync(self):
+        served = [json.loads(item)[u"data"] for item in self.server.library().itemsSince(0)]
+        items = dict([(item.id, item) for item in self.library.LibraryItems])
+        self.assertEqual(sorted(items.keys()), sorted([data[u"key"] for data in served]))
+        for data in served:
+            self.assertEqual(items[data[u"key"]].title, data[u"title"])
+        versions = self.store._ZoteroItemStore__libraryVersions
+        self.assertEqual(versions[(self.server.userId, u"user")], str(self.server.library().version))
+
+    def testIncrementalSync(self):
+        self.library.update()
+        self.assertInSync()
+        self.server.modify(7, 3)
+        self.server.resetStats()
+        self.library.update()
+        self.assertInSync()
+        # Only the changed items are retrieved, which fit in a single page
+        self.assertEqual(self.server.requests, 3)
+
+    def testSyncWithoutChanges(self):
+        self.library.update()
+        itemCount = len(self.library.LibraryItems)
+        self.server.resetStats()
+        self.library.update()
+        self.assertInSync()
+        self.assertEqual(len(self.library.LibraryItems), itemCount)
+        # The groups are revalidated, the items are asked for since the synced version, and as the
+        # version didn't change, deletions aren't
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.server.notModified, 1)
+        self.server.resetStats()
+        self.library.update()
+        self.assertInSync()
+        # Now the items since the synced version are revalidated as well
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.server.notModified, 2)
+
+
+class TestImport(unittest.TestCase):
+    def testImportDefersPyzotero(self):
+        """Loading the plugin shouldn't import pyzotero or its dependencies"""
+        script = ('import sys; import library; '
+                  'print sorted([m for m in sys.modules if m.split(".")[0] in ("pyzotero", "feedparser", "pytz") '
+                  'and sys.modules[m] is not None])')
+        # With the paths of this test, so pyzotero would be found if it were imported
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE, env=env,
+                                  cwd=root).communicate()[0]
+        self.assertEqual(output.splitlines()[-1], "[]")
+
+
+if __name__ == "__main__":
+    unittest.main()